@@ -0,0 +1,166 @@
+""" Projectr - Finding projectors on the local network
+
+Projectors broadcast an announcement every few seconds, MAGIC followed by
+a JSON body,
+
+    {"id": ..., "name": ..., "port": ..., "width": ..., "height": ...,
+     "free": bytes of free storage, "version": protocol version}
+
+The server listens for them and keeps a registry of what it has heard,
+forgetting a projector once it has been quiet for longer than the TTL.
+Projectors are told apart by id, from machine_id(), as every Pi is called
+raspberrypi until someone renames it. The name is only shown to people.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+
+PORT = 50000
+# To make sure we don't confuse or get confused by other programs
+MAGIC = b"sdf876sd"
+
+# Seconds between announcements, and until a quiet projector is forgotten
+ANNOUNCE_INTERVAL = 5
+TTL = 20
+
+# Biggest announcement read
+MAXANNOUNCEMENT = 4096
+
+# Written when the OS is installed, unique to each card
+MACHINEID = "/etc/machine-id"
+
+
+def machine_id():
+    """ Something that tells this machine apart from every other
+
+    The systemd machine id, or the MAC address where there isn't one. """
+    try:
+        with open(MACHINEID) as infile:
+            ident = infile.read().strip()
+        if ident:
+            return ident
+    except (IOError, OSError):
+        pass
+    return "%012x" % uuid.getnode()
+
+
+def announcement_key(ip, info):
+    """ What the registry knows a projector by
+
+    Its id, or where it is for projectors too old to send one. """
+    return info.get("id") or "%s:%s" % (ip, info["port"])
+
+
+def encode_announcement(info):
+    return MAGIC + json.dumps(info, separators=(',', ':')).encode('utf-8')
+
+
+def decode_announcement(data):
+    """ Return the body of an announcement, or None if it isn't one """
+    if not data.startswith(MAGIC):
+        return None
+    try:
+        info = json.loads(data[len(MAGIC):].decode('utf-8'))
+    except ValueError:
+        return None
+    if not isinstance(info, dict) or "name" not in info or "port" not in info:
+        return None
+    return info
+
+
+class Announcer(object):
+    """ Broadcast what a projector is, every ANNOUNCE_INTERVAL seconds
+
+    info is called for each announcement, so it can change as the
+    projector starts up and its storage fills. """
+    def __init__(self, info, port=PORT, interval=ANNOUNCE_INTERVAL):
+        self.info = info
+        self.port = port
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def start(self):
+        worker = threading.Thread(target=self.run, name="Announcer")
+        worker.daemon = True
+        worker.start()
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        while not self.stopped.is_set():
+            try:
+                sock.sendto(encode_announcement(self.info()),
+                            ('<broadcast>', self.port))
+            except (socket.error, OSError):
+                # No network yet, try again next time
+                logging.warning("Could not send announcement", exc_info=True)
+            self.stopped.wait(self.interval)
+        sock.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Registry(object):
+    """ Projectors heard announcing themselves, by announcement_key()
+
+    on_change(key, entry) is called when a projector appears or what it
+    announces changes, and on_change(key, None) when it is forgotten. """
+    def __init__(self, on_change=None, ttl=TTL, port=PORT):
+        self.on_change = on_change
+        self.ttl = ttl
+        self.port = port
+        self.entries = {}
+
+    def start(self):
+        worker = threading.Thread(target=self.run, name="Registry")
+        worker.daemon = True
+        worker.start()
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.port))
+        # Wake up now and then to forget quiet projectors
+        sock.settimeout(self.ttl / 4)
+        while True:
+            try:
+                data, address = sock.recvfrom(MAXANNOUNCEMENT)
+            except socket.timeout:
+                pass
+            else:
+                info = decode_announcement(data)
+                if info is not None:
+                    self.seen(address[0], info)
+            self.expire()
+
+    def seen(self, ip, info):
+        """ Record an announcement """
+        key = announcement_key(ip, info)
+        entry = dict(info, ip=ip)
+        old = self.entries.get(key)
+        self.entries[key] = dict(entry, seen=time.time())
+        if old is None or dict(old, seen=None) != dict(entry, seen=None):
+            self.changed(key, entry)
+
+    def expire(self):
+        """ Forget projectors that have gone quiet """
+        cutoff = time.time() - self.ttl
+        for key in list(self.entries):
+            if self.entries[key]["seen"] < cutoff:
+                del self.entries[key]
+                self.changed(key, None)
+
+    def changed(self, key, entry):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(key, entry)
+        except Exception:
+            logging.exception("Registry change for %s failed", key)
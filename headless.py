@@ -0,0 +1,165 @@
+""" Projectr - Stand-in for the parts of pi3d the projector uses
+
+For running the Carousel without a screen or GPU, on a build server or in
+the benchmarks under tests/. Nothing is drawn and textures only keep their
+size, but everything the projector calls is there and counted, so the
+render loop does the same work on the CPU that it does on a Pi.
+
+    python projector.py --headless
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+import weakref
+
+from PIL import Image
+
+# Frame size used when none is asked for, a 1080p projector
+WIDTH = 1920
+HEIGHT = 1080
+
+# What would have reached the GPU since the last reset()
+STATS = {"draws": 0, "textures": 0, "uploads": 0, "uploaded": 0}
+# Textures still referenced, pi3d frees the GL side when they go
+LIVE = weakref.WeakSet()
+
+
+def reset():
+    for key in STATS:
+        STATS[key] = 0
+
+
+def live_bytes():
+    """ Memory the textures still alive would be using on the GPU """
+    return sum(texture.bytes() for texture in LIVE)
+
+
+class Display(object):
+    """ A display with nothing on it
+
+    loop_running() keeps to frames_per_second like pi3d's does, or runs
+    as fast as it is called if that is None. """
+    INSTANCE = None
+
+    def __init__(self, width, height, frames_per_second):
+        self.width = width
+        self.height = height
+        self.frames_per_second = frames_per_second
+        self.is_running = True
+        self.frames = 0
+        self.next_frame = None
+
+    @classmethod
+    def create(cls, background=None, frames_per_second=20, w=WIDTH, h=HEIGHT,
+               **kwargs):
+        cls.INSTANCE = cls(w, h, frames_per_second)
+        return cls.INSTANCE
+
+    def loop_running(self):
+        """ Wait for the next frame, returns False once stopped """
+        if self.frames_per_second and self.next_frame is not None:
+            delay = self.next_frame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if self.frames_per_second:
+            self.next_frame = time.time() + 1 / self.frames_per_second
+        if self.is_running:
+            self.frames += 1
+        return self.is_running
+
+    def stop(self):
+        self.is_running = False
+
+
+class Texture(object):
+    """ The size of an image, from a file or an array of pixels """
+    def __init__(self, file_string, blend=False, mipmap=True, **kwargs):
+        self.blend = blend
+        self.mipmap = mipmap
+        if hasattr(file_string, "shape"):
+            self.iy, self.ix = file_string.shape[:2]
+        else:
+            # pi3d would decode it, the header is enough here
+            self.ix, self.iy = Image.open(file_string).size
+        STATS["textures"] += 1
+        self.upload()
+        LIVE.add(self)
+
+    def bytes(self):
+        size = self.ix * self.iy * 4
+        if self.mipmap is True:
+            size += size // 3
+        return size
+
+    def upload(self):
+        STATS["uploads"] += 1
+        STATS["uploaded"] += self.bytes()
+
+    def update_ndarray(self, new_array=None, texture_num=None):
+        """ Replace the pixels, which must be the same size """
+        if new_array is not None and new_array.shape[:2] != (self.iy, self.ix):
+            raise ValueError("Frame is %sx%s, texture is %dx%d" %
+                             (new_array.shape[1], new_array.shape[0],
+                              self.ix, self.iy))
+        self.upload()
+
+
+class Shader(object):
+    def __init__(self, shfile=None, **kwargs):
+        self.shfile = shfile
+
+
+class Canvas(object):
+    """ Keeps what it was last told to draw, for checking """
+    def __init__(self):
+        self.shader = None
+        self.textures = []
+        # Shader uniforms, set_custom_data(48, ...) is unif[16]
+        self.unif = [0.0] * 60
+        self.width = self.height = 0
+        self.x = self.y = self.z = 0.0
+
+    def set_2d_size(self, w=None, h=None, x=0, y=0):
+        self.width, self.height, self.x, self.y = w, h, x, y
+        # Where pi3d puts them, unif[14] and unif[15]
+        self.unif[42:44] = [x, y]
+        self.unif[45:48] = [w, h, h]
+
+    def set_shader(self, shader):
+        self.shader = shader
+
+    def positionZ(self, z):
+        self.z = z
+
+    def set_draw_details(self, shader, textures, **kwargs):
+        self.shader = shader
+        self.textures = list(textures)
+
+    def set_custom_data(self, index_from, data):
+        self.unif[index_from:index_from + len(data)] = data
+
+    def draw(self):
+        STATS["draws"] += 1
+
+
+class Camera(object):
+    INSTANCE = None
+
+    def __init__(self):
+        self.was_moved = False
+
+    @classmethod
+    def instance(cls):
+        if cls.INSTANCE is None:
+            cls.INSTANCE = cls()
+        return cls.INSTANCE
+
+
+class Keyboard(object):
+    """ No keys are ever pressed, stop it with Ctrl-C """
+    def read(self):
+        return -1
+
+    def close(self):
+        pass
@@ -0,0 +1,208 @@
+""" Projectr - Counters, gauges and histograms for /metrics
+
+Both processes keep a Registry of their metrics. The projector sends a
+snapshot of its registry to the server when asked, as JSON over the control
+connection, and the server's /metrics page writes its own and every
+display's in the Prometheus text format, each display's labelled with its
+name.
+
+A snapshot is a list of families,
+
+    {"name": ..., "type": "counter", "gauge" or "histogram", "help": ...,
+     "samples": [[{label: value}, value], ...]}
+
+where a histogram's value is {"buckets": [[le, count], ...], "sum": ...,
+"count": ...}, bucket counts including everything in smaller buckets.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bisect
+import threading
+
+# Seconds, from a quick frame to a slow upload
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+           5, 10)
+
+
+class Metric(object):
+    """ One named metric, with a value for each set of labels """
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("%s has labels %s, not %s" %
+                             (self.name, self.labels, tuple(labels)))
+        return tuple(labels[label] for label in self.labels)
+
+    def family(self):
+        """ This metric in a snapshot """
+        with self.lock:
+            samples = [[dict(zip(self.labels, key)), self.sample(value)]
+                       for key, value in sorted(self.values.items())]
+        return {"name": self.name, "type": self.kind, "help": self.doc,
+                "samples": samples}
+
+    def sample(self, value):
+        return value
+
+
+class Counter(Metric):
+    """ A count that only goes up """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """ For counts kept elsewhere, copied in when a snapshot is taken """
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Gauge(Metric):
+    """ A value that goes up and down """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def clear(self):
+        """ Forget every label set, for gauges refilled on each snapshot """
+        with self.lock:
+            self.values.clear()
+
+
+class Histogram(Metric):
+    """ How many observations fell into each bucket """
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # Counts for each bucket, the last one is +Inf, then the sum
+            counts = self.values.get(key)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[key] = counts
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def sample(self, counts):
+        buckets = []
+        total = 0
+        for le, count in zip(self.buckets, counts):
+            total += count
+            buckets.append([le, total])
+        return {"buckets": buckets, "sum": counts[-1],
+                "count": total + counts[-2]}
+
+
+class Registry(object):
+    """ The metrics of one process
+
+    Collectors are called before every snapshot, to copy in values that
+    are kept elsewhere, such as the texture cache's counters. """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.add(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.add(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, doc, labels, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        for collector in self.collectors:
+            collector()
+        return [metric.family() for metric in self.metrics]
+
+
+def relabel(families, **labels):
+    """ Add labels to every sample of a snapshot """
+    return [dict(family, samples=[[dict(sample_labels, **labels), value]
+                                  for sample_labels, value in
+                                  family["samples"]])
+            for family in families]
+
+
+def escape(value, quotes=True):
+    """ Escape a label value, or HELP text which leaves quotes alone """
+    value = ("%s" % value).replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quotes else value
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(labels[name]))
+                             for name in sorted(labels))
+
+
+def format_value(value):
+    if value is True or value is False:
+        value = int(value)
+    return repr(float(value)) if isinstance(value, float) else "%d" % value
+
+
+def format_text(families):
+    """ Snapshots in the Prometheus text format
+
+    Families with the same name, from different processes, are written
+    together under one HELP and TYPE. """
+    merged = []
+    byname = {}
+    for family in families:
+        if family["name"] in byname:
+            byname[family["name"]]["samples"].extend(family["samples"])
+        else:
+            byname[family["name"]] = dict(family,
+                                          samples=list(family["samples"]))
+            merged.append(byname[family["name"]])
+
+    lines = []
+    for family in merged:
+        name = family["name"]
+        doc = escape(family["help"], quotes=False)
+        lines.append("# HELP %s %s" % (name, doc))
+        lines.append("# TYPE %s %s" % (name, family["type"]))
+        for labels, value in family["samples"]:
+            if family["type"] != "histogram":
+                lines.append("%s%s %s" % (name, format_labels(labels),
+                                          format_value(value)))
+                continue
+            for le, count in value["buckets"]:
+                lines.append("%s_bucket%s %d" % (
+                    name, format_labels(dict(labels, le=le)), count))
+            lines.append("%s_bucket%s %d" % (
+                name, format_labels(dict(labels, le="+Inf")), value["count"]))
+            lines.append("%s_sum%s %s" % (name, format_labels(labels),
+                                          format_value(value["sum"])))
+            lines.append("%s_count%s %d" % (name, format_labels(labels),
+                                            value["count"]))
+    return "\n".join(lines) + "\n"
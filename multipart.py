@@ -0,0 +1,144 @@
+""" Projectr - Reading multipart/form-data uploads as they arrive
+
+cgi.FieldStorage, which web.input uses, writes a whole upload to a
+temporary file before handing it over. MultipartReader reads the parts of
+the body straight from the request instead, so an upload can be checked
+from its first chunk and is written to disk only once.
+
+    reader = MultipartReader(env['wsgi.input'], boundary(content_type),
+                             length)
+    name, filename = reader.next_part()
+    chunk = reader.read()
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+
+CHUNK = 64 * 1024
+# Biggest block of headers a part may have
+MAXHEADERS = 16 * 1024
+
+
+class MultipartError(ValueError):
+    """ The body isn't multipart/form-data, or is cut short """
+
+
+def boundary(content_type):
+    """ The boundary from a Content-Type header, None if it has none """
+    content_type = content_type or ""
+    if not content_type.lower().startswith("multipart/form-data"):
+        return None
+    match = re.search(r';\s*boundary=(?:"([^"]+)"|([^;\s]+))', content_type,
+                      re.IGNORECASE)
+    if match is None:
+        return None
+    return (match.group(1) or match.group(2)).encode('ascii')
+
+
+def disposition(value):
+    """ Field name and filename from a Content-Disposition header """
+    fields = {}
+    for key in ("name", "filename"):
+        match = re.search(r'\b%s=(?:"([^"]*)"|([^;\s]*))' % key, value)
+        if match is not None:
+            quoted, bare = match.groups()
+            fields[key] = bare if quoted is None else quoted
+    return fields.get("name"), fields.get("filename")
+
+
+class MultipartReader(object):
+    """ The parts of a multipart/form-data body, one at a time
+
+    next_part() skips whatever is left of the current part and returns
+    the next one's field name and filename, or None after the last. read()
+    then returns its content, a chunk at a time, and b'' at its end. No
+    more than a chunk and a boundary is ever held in memory. """
+    def __init__(self, stream, boundary, length=None, chunksize=CHUNK):
+        self.stream = stream
+        # Bytes of the body still to read, None to read to the end
+        self.left = length
+        self.chunksize = chunksize
+        # Each part ends with a CRLF and the boundary. The body doesn't
+        # start with a CRLF, so one is put in front to find the first
+        self.delimiter = b"\r\n--" + boundary
+        self.buf = b"\r\n"
+        self.inpart = False
+        self.finished = False
+
+    def fill(self):
+        """ Read more of the body, returns False at its end """
+        size = self.chunksize
+        if self.left is not None:
+            size = min(size, self.left)
+        data = self.stream.read(size) if size > 0 else b""
+        if not data:
+            self.left = 0
+            return False
+        if self.left is not None:
+            self.left -= len(data)
+        self.buf += data
+        return True
+
+    def read(self, size=None):
+        """ Up to size bytes more of the current part """
+        if not self.inpart:
+            return b""
+        size = size or self.chunksize
+        while True:
+            index = self.buf.find(self.delimiter)
+            if index >= 0:
+                end = index
+                break
+            # Hold back what could be the start of the delimiter
+            end = len(self.buf) - len(self.delimiter) + 1
+            if end >= size:
+                break
+            if not self.fill():
+                raise MultipartError("The upload was cut short")
+        if end == 0:
+            self.inpart = False
+            return b""
+        end = min(end, size)
+        data, self.buf = self.buf[:end], self.buf[end:]
+        return data
+
+    def next_part(self):
+        """ Move on to the next part, returns (name, filename) or None """
+        while self.read():
+            pass
+        if self.finished:
+            return None
+
+        # Skip to the boundary, past a preamble before the first part
+        while True:
+            index = self.buf.find(self.delimiter)
+            if index >= 0:
+                self.buf = self.buf[index + len(self.delimiter):]
+                break
+            self.buf = self.buf[-len(self.delimiter):]
+            if not self.fill():
+                raise MultipartError("No parts in the upload")
+        while len(self.buf) < 2:
+            if not self.fill():
+                raise MultipartError("The upload was cut short")
+        if self.buf.startswith(b"--"):
+            self.finished = True
+            return None
+
+        # Headers follow the CRLF ending the boundary line
+        while True:
+            index = self.buf.find(b"\r\n\r\n")
+            if index >= 0:
+                break
+            if len(self.buf) > MAXHEADERS:
+                raise MultipartError("Part headers are too long")
+            if not self.fill():
+                raise MultipartError("The upload was cut short")
+        headers = {}
+        for line in self.buf[2:index].split(b"\r\n"):
+            key, _, value = line.decode('utf-8', 'replace').partition(":")
+            headers[key.strip().lower()] = value.strip()
+        self.buf = self.buf[index + 4:]
+        self.inpart = True
+        return disposition(headers.get("content-disposition", ""))
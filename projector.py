@@ -2,7 +2,11 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import pi3d
+try:
+    import pi3d
+except ImportError:
+    # Only --headless can run without it, e.g. on a build server
+    pi3d = None
 # General
 import os
 import logging
@@ -10,14 +14,24 @@ import time
 import sys
 from datetime import datetime
 import argparse
-import multiprocessing
-import yaml
+import collections
+from collections import OrderedDict
+import threading
+import Queue
+import numpy
+import hashlib
+from PIL import Image, ImageSequence
+import re
 
 # Networking
-import struct
-import thread
+import fcntl
+import select
 import socket
-import pickle
+import protocol
+import discovery
+import settingsstore
+import headless
+import metrics
 
 """
 Projectr - Projector Process
@@ -31,42 +45,123 @@ logging.basicConfig(
 )
 
 IMAGEDIR = 'static/images/'
+VIDEODIR = 'static/videos/'
+
+# Animations, a folder of numbered frames is played as one too
+ANIMATIONTYPES = ('.gif', '.png', '.apng')
+# Frames decoded ahead of the render loop, and textures they are shown from
+FRAMES_AHEAD = 4
+FRAME_RING = 3
+
+# Fade curves, from how far through the fade is to how far to blend
+EASINGS = {
+    "linear": lambda t: t,
+    "ease-in": lambda t: t * t,
+    "ease-out": lambda t: t * (2 - t),
+    "ease-in-out": lambda t: t * t * (3 - 2 * t),
+}
+
+# Render loop rate, and how long each frame is on screen
+FPS = 20
+FRAMETIME = 1 / FPS
+# How often the keyboard is read while nothing is being drawn
+IDLE_TICK = 0.1
+# Seconds between logging what idling has saved
+RENDER_REPORT = 600
 
 """ FUNCTIONS """
 
-# Use class for settings?
-def write_settings(process, data):
-    """Write the previous image to settings file"""
-    logging.info("Writing settings...")
-    logging.info("Writing settings...")
-    with open('settings.yml', 'w') as outfile:
-        outfile.write(yaml.dump(data, default_flow_style=True))
-
-
-def read_settings(process):
-    logging.info("Read settings...")
-    try:
-        return yaml.load(open("settings.yml"))
-    except:
-        logging.exception("Could not read settings")
-        logging.info("Writing default settings file")
-        data = {
-                'slideshow': {'delay': 20, 'loop': True},
-                'fadeduration': 2,
-                'lastimage': u'static/images/logo.jpg',
-                'projectors': {
-                    'local': {
-                        'ip': '127.0.0.1',
-                        'port': 5006,
-                        'enabled': True,
-                        'name': 'Main',
-                        'current': '',
-                    }
-                }
-                }
-        with open('settings.yml', 'w') as outfile:
-            outfile.write(yaml.dump(data, default_flow_style=True))
-        return data
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock, ask for CLOCK_MONOTONIC ourselves
+    import ctypes
+    import ctypes.util
+
+    class _Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or
+                                 ctypes.util.find_library("c"),
+                                 use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        """ Seconds from an arbitrary point, never goes backwards """
+        timespec = _Timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+
+# Written to settings.yml if there isn't one
+DEFAULTS = {
+    'slideshow': {'delay': 20, 'loop': True, 'lookahead': 2},
+    'fadeduration': 2,
+    'fadeeasing': 'linear',
+    'texturecache': {'budget': 48},
+    'control': {'host': '0.0.0.0', 'port': 5006},
+    'discovery': {'announce': True},
+    'lastimage': u'static/images/logo.jpg',
+    'projectors': {
+        'local': {
+            'ip': '127.0.0.1',
+            'port': 5006,
+            'enabled': True,
+            'name': 'Main',
+            'current': '',
+        }
+    }
+}
+
+# Sent to the servers when they ask, see metrics.py
+METRICS = metrics.Registry()
+FRAME_TIME = METRICS.histogram(
+    "projectr_frame_seconds", "Time to tick, collect, update and draw a frame")
+DECODE_TIME = METRICS.histogram(
+    "projectr_texture_decode_seconds",
+    "Time to decode an image, or a frame of an animation", ("kind",))
+UPLOAD_TIME = METRICS.histogram(
+    "projectr_texture_upload_seconds",
+    "Time to upload an image, or a frame of an animation, to the GPU",
+    ("kind",))
+FADE_DELAY = METRICS.histogram(
+    "projectr_fade_start_delay_seconds",
+    "How long after an image was due its fade started")
+VISIBLE_DELAY = METRICS.histogram(
+    "projectr_due_to_visible_seconds",
+    "How long after an image was due its first frame was drawn")
+ANIMATION_STALLS = METRICS.counter(
+    "projectr_animation_stalls_total",
+    "Frames an animation's decoder wasn't ready with in time")
+SCHEDULED_UNLOADED = METRICS.counter(
+    "projectr_scheduled_unloaded_total",
+    "Scheduled switches due before their image was loaded")
+# Kept elsewhere and copied in by collect_metrics
+CACHE_BYTES = METRICS.gauge(
+    "projectr_texture_cache_bytes", "GPU memory used by the texture cache")
+CACHE_BUDGET = METRICS.gauge(
+    "projectr_texture_cache_budget_bytes", "Texture cache budget")
+CACHE_ENTRIES = METRICS.gauge(
+    "projectr_texture_cache_entries", "Images in the texture cache")
+CACHE_LOOKUPS = METRICS.counter(
+    "projectr_texture_cache_lookups_total", "Texture cache lookups",
+    ("result",))
+CACHE_EVICTIONS = METRICS.counter(
+    "projectr_texture_cache_evictions_total", "Images evicted from the cache")
+LOADS_CANCELLED = METRICS.counter(
+    "projectr_loads_cancelled_total", "Image loads given up on")
+COMMANDS = METRICS.counter(
+    "projectr_commands_total",
+    "Commands for the render loop, applied or replaced before it got to them",
+    ("result",))
+QUEUE_DEPTH = METRICS.gauge(
+    "projectr_queue_depth", "Items waiting in each queue", ("queue",))
+FRAMES = METRICS.counter("projectr_frames_total", "Frames drawn")
+IDLE = METRICS.counter("projectr_idle_seconds_total",
+                       "Seconds spent not drawing as nothing was changing")
 
 
 def fit_image(input_texture):
@@ -102,300 +197,1237 @@ def list_files(directory, reverse=False):
     return output
 
 
-""" NETWORKING """
+def list_images(directory):
+    """ Return the path of every image under a directory """
+    output = []
+    for root, dirs, files in os.walk(directory):
+        output.extend(os.path.join(root, f) for f in files if
+                      f.endswith(('.jpg', '.jpeg', '.png')))
+    return output
 
 
-# SENDING AND RECEIVING
-def send_msg(sock, msg):
-    """ Prefix each message with a 4-byte length (network byte order) """
-    msg = struct.pack('>I', len(msg)) + msg
-    sock.sendall(msg)
+def is_animation(path):
+    """ Whether the Carousel can play a file or folder """
+    return os.path.isdir(path) or path.lower().endswith(ANIMATIONTYPES)
 
 
-def recv_msg(sock):
-    """ Read message length and unpack it into an integer """
-    raw_msglen = recvall(sock, 4)
-    if not raw_msglen:
-        return None
-    msglen = struct.unpack('>I', raw_msglen)[0]
-    # Read the message data
-    return recvall(sock, msglen)
+def safe_video_path(video):
+    """ Check a path sent by the server stays inside the video folder """
+    path = os.path.normpath(video)
+    return (not os.path.isabs(path) and
+            path.startswith(os.path.normpath(VIDEODIR) + os.sep))
 
 
-def recvall(sock, n):
-    """ Helper function to recv n bytes or return None if EOF is hit """
-    data = ''
+def safe_image_path(image):
+    """ Check a path sent by the server stays inside the image folders """
+    path = os.path.normpath(image)
+    return (not os.path.isabs(path) and
+            path.startswith((os.path.normpath(IMAGEDIR) + os.sep,
+                             os.path.join('static', 'img') + os.sep)))
 
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            return None
-        print(packet)
-        data += packet
 
-    return data
+""" NETWORKING """
 
 
-""" PROCESSES """
+class Connection(object):
+    """ A connected server
+
+    Only the control loop thread touches a connection. Frames are read
+    into inbuf until they are whole and replies wait in outbuf until the
+    socket can take them, so one slow server never holds up another. """
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        # No requests are handled until the server has said HELLO
+        self.greeted = False
+        # Files being received, by the id of their store request
+        self.transfers = {}
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, kind, msgid, body=None):
+        self.outbuf.extend(protocol.encode(kind, msgid, body))
+
+    def flush(self):
+        """ Send as much of outbuf as the socket will take """
+        sent = self.sock.send(bytes(self.outbuf))
+        del self.outbuf[:sent]
+
+
+class Transfer(object):
+    """ A file the server is streaming over in DATA frames
+
+    The file is only cached if its hash matches, otherwise it is thrown
+    away and the server can try again. """
+    def __init__(self, image, size, sha1):
+        self.image = image
+        self.size = size
+        self.sha1 = sha1
+        self.received = 0
+        self.digest = hashlib.sha1()
+        self.keep = safe_image_path(image)
+        self.tmppath = image + ".part"
+        self.fout = None
+        if self.keep:
+            if not os.path.isdir(os.path.dirname(image)):
+                os.makedirs(os.path.dirname(image))
+            self.fout = open(self.tmppath, 'wb')
+
+    def complete(self):
+        return self.received >= self.size
+
+    def write(self, chunk):
+        self.received += len(chunk)
+        self.digest.update(chunk)
+        if self.keep:
+            self.fout.write(chunk)
+
+    def finish(self):
+        """ Cache the file if it arrived intact, returns whether it was """
+        if not self.keep:
+            logging.warning("Refused to store %s", self.image)
+            return False
+
+        self.fout.close()
+        if self.digest.hexdigest() != self.sha1:
+            logging.error("%s failed hash check, discarding", self.image)
+            os.remove(self.tmppath)
+            return False
+
+        os.rename(self.tmppath, self.image)
+        logging.info("Cached %s", self.image)
+        return True
+
+    def abort(self):
+        """ Throw away a file that didn't finish arriving """
+        if self.keep:
+            self.fout.close()
+            os.remove(self.tmppath)
+
+
+""" THREADS """
+
+
+class Slideshow(object):
+    """ Steps through a slideshow off monotonic deadlines
+
+    There is no thread, the control loop asks how long until the next
+    slide is due and runs it then. Each deadline is the last one plus the
+    slide time, so slides don't drift and loading an image doesn't make
+    its slide longer. Changes of state are passed to notify(event). """
+    def __init__(self, commands, notify):
+        self.commands = commands
+        self.notify = notify
+        self.images = []
+        self.index = 0
+        # When the next slide is due, None while paused or stopped
+        self.deadline = None
+        # Time left on the slide when it was paused
+        self.remaining = None
+
+    def running(self):
+        return bool(self.images)
+
+    def period(self):
+        """ Seconds each slide is on screen, the fade included """
+        return SETTINGS["slideshow"]["delay"] + SETTINGS["fadeduration"]
+
+    def start(self, images):
+        if not images:
+            logging.info("Slideshow with no images, stopping instead")
+            self.stop()
+            return
+        logging.info("Starting slideshow of %d images", len(images))
+        self.images = list(images)
+        self.index = 0
+        self.remaining = None
+        # First slide straight away
+        self.deadline = monotonic()
+        self.notify({"event": "slideshow", "slideshow": True,
+                     "paused": False})
+
+    def stop(self):
+        if self.running():
+            logging.info("Slideshow stopped")
+            self.images = []
+            self.deadline = None
+            self.remaining = None
+            self.notify({"event": "slideshow", "slideshow": False,
+                         "paused": False})
+
+    def pause(self):
+        if self.running() and self.deadline is not None:
+            self.remaining = max(self.deadline - monotonic(), 0)
+            self.deadline = None
+            self.notify({"event": "slideshow", "paused": True})
+
+    def resume(self):
+        if self.running() and self.deadline is None:
+            self.deadline = monotonic() + self.remaining
+            self.remaining = None
+            self.notify({"event": "slideshow", "paused": False})
+
+    def skip(self):
+        """ Show the next slide now """
+        if self.running():
+            self.deadline = monotonic()
+            self.remaining = None
+
+    def timeout(self):
+        """ Seconds until the next slide is due, or None if none is """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - monotonic(), 0)
+
+    def run(self):
+        """ Show the next slide if it is due """
+        if self.deadline is None or monotonic() < self.deadline:
+            return
+        if not self.images:
+            # Nothing to show, or timeout() would keep saying it is due
+            self.deadline = None
+            return
+        if self.index >= len(self.images):
+            if SETTINGS["slideshow"].get("loop", True) is not True:
+                self.stop()
+                return
+            self.index = 0
+
+        image = self.images[self.index]
+        logging.info("Slideshow: %s", image)
+        self.commands.put({"action": "show", "image": image,
+                           "due": time.time()})
+
+        # Load the next images while this one is on screen
+        lookahead = SETTINGS["slideshow"].get("lookahead", 2)
+        upcoming = [self.images[(self.index + n) % len(self.images)]
+                    for n in range(1, lookahead + 1)]
+        self.commands.put({"action": "prefetch", "images": upcoming})
+
+        self.index += 1
+        self.deadline += self.period()
+        if self.deadline < monotonic():
+            # Fell a whole slide behind, paused by a debugger or the like,
+            # start counting again rather than rushing to catch up
+            self.deadline = monotonic() + self.period()
+
+
+class CommandChannel(object):
+    """ Hands commands from the network to the render loop
+
+    Only the latest command for each action is kept. A show that hasn't
+    been picked up yet is replaced by a newer one rather than queued
+    behind it, so a burst of taps only loads the last image. Setting and
+    popping a dict item are atomic, so neither side takes a lock. """
+    # Order commands taken together are applied in
+    ORDER = ("show", "prefetch", "preload")
 
+    def __init__(self):
+        self.latest = {}
+        self.dropped = 0
+        self.applied = 0
+        # Set when a command arrives, wakes an idle render loop
+        self.wakeup = threading.Event()
+
+    def __len__(self):
+        return len(self.latest)
+
+    def put(self, command):
+        if self.latest.pop(command["action"], None) is not None:
+            self.dropped += 1
+        self.latest[command["action"]] = command
+        self.wakeup.set()
+
+    def take(self):
+        """ Return the commands waiting for the render loop """
+        commands = []
+        for action in self.ORDER:
+            command = self.latest.pop(action, None)
+            if command is not None:
+                commands.append(command)
+        self.applied += len(commands)
+        return commands
+
+    def stats(self):
+        return {"applied": self.applied, "dropped": self.dropped}
+
+
+class ControlServer(object):
+    """ Serve every server connection from one event loop thread
+
+    Commands for the render loop go through a CommandChannel and events
+    from it come back on a deque, so neither thread ever waits on a lock,
+    and a pipe wakes this loop when there is an event to send. """
+    def __init__(self, address):
+        self.process = "Control Server"
+        # Picked up by the render loop each frame
+        self.commands = CommandChannel()
+        # State changes from the render loop for the servers
+        self.events = collections.deque()
+        # Display details for the server, filled in once the display is up
+        self.displayinfo = {}
+        # Connected servers by socket
+        self.connections = {}
+        # Preload requests waiting for their image, (conn, id) by image
+        self.preloads = {}
+        # Slides are run by this loop, between connections
+        self.slideshow = Slideshow(self.commands, self.publish)
+
+        # What the projector is doing, kept up to date by events
+        self.state = {"image": SETTINGS["lastimage"], "fading": False,
+                      "slideshow": False, "paused": False}
+
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        logging.info('Starting up on %s port %s' % address)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(5)
+        self.listener.setblocking(False)
+        self.running = True
+
+    def start(self):
+        self.worker = threading.Thread(target=self.run, name="ControlServer")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b'!')
+        except OSError:
+            # Pipe already full, the loop is awake anyway
+            pass
+
+    def announcement(self):
+        """ What this projector tells the network about itself """
+        storage = os.statvfs(IMAGEDIR)
+        return dict(self.displayinfo, id=discovery.machine_id(),
+                    name=socket.gethostname(),
+                    port=self.listener.getsockname()[1],
+                    free=storage.f_bavail * storage.f_frsize,
+                    version=protocol.VERSION)
+
+    def post_event(self, event):
+        """ Queue an event for the servers, called from the render loop """
+        self.events.append(event)
+        self.wake()
+
+    def run(self):
+        """ The event loop """
+        while self.running:
+            readers = ([self.listener, self.wake_r] +
+                       list(self.connections.values()))
+            writers = [conn for conn in self.connections.values()
+                       if conn.outbuf]
+            # Wake up in time for the next slide
+            readable, writable, _ = select.select(readers, writers, [],
+                                                  self.slideshow.timeout())
+
+            for conn in writable:
+                try:
+                    conn.flush()
+                except socket.error:
+                    logging.warning("Could not write to %s", conn.address)
+                    self.drop(conn)
+
+            for ready in readable:
+                if ready is self.listener:
+                    self.accept()
+                elif ready == self.wake_r:
+                    self.publish_events()
+                elif ready.sock in self.connections:
+                    self.read(ready)
 
-def slideshow(imagelist, cur_queue, killslideshowq):
-    """ run slideshow """
-    process = "Slideshow Process"
+            try:
+                self.slideshow.run()
+            except Exception:
+                logging.exception("Slideshow failed, stopping it")
+                self.slideshow.stop()
+        self.close()
 
-    settings = read_settings(process)
-    logging.info("Starting slideshow...")
-    working = True
-    while working is True:
-        for image in imagelist:
-            # Check to see if slideshow needs to die
-            if not killslideshowq.empty():
-                emptyq = killslideshowq.get()
-                if emptyq == "die":
-                    logging.info("Killing slideshow")
-                    working = False  # Make sure while loop breaks
-                    break  # break out of for loop
-            logging.info("Slideshow: %s", image)
-            cur_queue.put(image)
-            time.sleep(settings["slideshow"]["delay"] + settings["fadeduration"])
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        logging.info("Connection from %s", str(address))
+        sock.setblocking(False)
+        # Events and replies are small frames, send them as they come
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections[sock] = Connection(sock, address)
+
+    def read(self, conn):
+        """ Read whatever has arrived and handle each whole frame """
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error:
+            logging.exception("Read from %s failed", conn.address)
+            data = b''
+        if not data:
+            logging.info("Master %s disconnected", conn.address)
+            self.drop(conn)
+            return
+
+        conn.inbuf.extend(data)
+        try:
+            for frame in protocol.read_frames(conn.inbuf):
+                if conn.greeted:
+                    self.handle_safely(conn, *frame)
+                else:
+                    self.greet(conn, frame)
+        except Exception:
+            # Anything else a frame or greeting can raise is from a peer
+            # we can't talk to, handle_safely deals with requests
+            logging.exception("Bad frame from %s", conn.address)
+            self.drop(conn)
+
+    def handle_safely(self, conn, kind, msgid, data):
+        """ Handle a frame, answering with an ERROR if that fails
+
+        A bad request or a full disk fails that request, not the loop
+        every server is served from. """
+        try:
+            self.handle(conn, kind, msgid, data)
+        except Exception as e:
+            logging.exception("Could not handle frame %d from %s", msgid,
+                              conn.address)
+            transfer = conn.transfers.pop(msgid, None)
+            if transfer is not None:
+                transfer.abort()
+            if kind in (protocol.REQUEST, protocol.DATA):
+                conn.send(protocol.ERROR, msgid, {"error": "%s" % e})
+
+    def greet(self, conn, frame):
+        """ Answer the server's HELLO with ours """
+        protocol.check_hello(frame)
+        conn.send(protocol.HELLO, 0,
+                  dict(self.displayinfo, version=protocol.VERSION,
+                       name=socket.gethostname()))
+        conn.greeted = True
+        logging.info("Connected to Master")
+
+    def drop(self, conn):
+        """ Forget a connection and anything it was sending """
+        self.connections.pop(conn.sock, None)
+        for transfer in conn.transfers.values():
+            transfer.abort()
+        conn.transfers.clear()
+        conn.sock.close()
+
+    def handle(self, conn, kind, msgid, data):
+        """ Handle one frame from a server """
+        if kind == protocol.DATA:
+            transfer = conn.transfers.get(msgid)
+            if transfer is None:
+                logging.warning("Data for unknown request %d", msgid)
+                return
+            transfer.write(data)
+            if transfer.complete():
+                del conn.transfers[msgid]
+                conn.send(protocol.REPLY, msgid, {"stored": transfer.finish()})
+            return
+        elif kind != protocol.REQUEST:
+            conn.send(protocol.ERROR, msgid,
+                      {"error": "Unexpected frame kind %d" % kind})
+            return
+
+        if data["action"] not in ("alive", "metrics"):
+            logging.info("Received TCP data: %s from %s", data, conn.address)
+        else:
+            logging.debug("%s?", data["action"])
+
+        if data["action"] in ("project", "slideshow", "stopslideshow"):
+            # If slideshow is running, stop it
+            self.slideshow.stop()
+
+        reply = {}
+        if data["action"] == "alive":
+            # The server times these to work out our clock offset
+            reply = {"time": time.time()}
+        elif data["action"] == "project":
+            if "images" in data:
+                image = data["images"][0]
+                if not safe_image_path(image):
+                    logging.warning("Refusing path %s", image)
+                else:
+                    # at is when to switch by our clock, so a wall of
+                    # projectors changes together
+                    self.commands.put({"action": "show", "image": image,
+                                       "due": data.get("at") or time.time(),
+                                       "at": data.get("at")})
+            elif "video" in data:
+                logging.info("Video to project is %s", data["video"])
+                video = data["video"][0]
+                if not safe_video_path(video):
+                    logging.warning("Refusing path %s", video)
+                elif is_animation(video):
+                    self.commands.put({"action": "show", "image": video,
+                                       "animation": True,
+                                       "due": time.time()})
+                else:
+                    logging.info("Can only play animations, not %s", video)
+            else:
+                logging.info("Nothing to project")
+        elif data["action"] == "slideshow":
+            images = [image for image in data["images"]
+                      if safe_image_path(image)]
+            if len(images) < len(data["images"]):
+                logging.warning("Refusing %d slideshow paths",
+                                len(data["images"]) - len(images))
+            self.slideshow.start(images)
+        elif data["action"] == "stopslideshow":
+            pass
+        elif data["action"] == "pauseslideshow":
+            self.slideshow.pause()
+        elif data["action"] == "resumeslideshow":
+            self.slideshow.resume()
+        elif data["action"] == "skipslideshow":
+            self.slideshow.skip()
+        elif data["action"] == "preload":
+            image = data["image"]
+            if not safe_image_path(image):
+                logging.warning("Refusing path %s", image)
+                reply = {"loaded": False, "refused": True}
+            else:
+                # Replied to once the render loop has it on the GPU. The
+                # command names every image waited for, as it replaces
+                # one the render loop hasn't taken yet
+                self.preloads.setdefault(image, []).append((conn, msgid))
+                self.commands.put({"action": "preload",
+                                   "images": sorted(self.preloads)})
+                reply = None
+        elif data["action"] == "sync":
+            reply = {"images": list_images(IMAGEDIR)}
+        elif data["action"] == "have":
+            if safe_image_path(data["image"]):
+                reply = {"have": os.path.isfile(data["image"])}
+            else:
+                logging.warning("Refusing path %s", data["image"])
+                reply = {"have": False, "refused": True}
+        elif data["action"] == "store":
+            transfer = Transfer(data["image"], data["size"], data["sha1"])
+            if transfer.complete():
+                reply = {"stored": transfer.finish()}
+            else:
+                # Replied to once the last DATA frame arrives
+                conn.transfers[msgid] = transfer
+                reply = None
+        elif data["action"] == "resolution":
+            reply = dict(self.displayinfo)
+        elif data["action"] == "whatsplaying":
+            reply = dict(self.state)
+        elif data["action"] == "metrics":
+            reply = {"metrics": METRICS.snapshot()}
+        else:
+            logging.info("Unkown action: %s", data["action"])
+            conn.send(protocol.ERROR, msgid,
+                      {"error": "Unknown action %s" % data["action"]})
+            return
 
+        if reply is not None:
+            conn.send(protocol.REPLY, msgid, reply)
 
-def client_handler(connection, client_address, cur_queue):
-    process = "Client Handler - %s" % os.urandom(8).encode('base_64')
-    logging.debug(connections)
-    # Is there a slideshow running?
-    slideshowon = False
-    killslideshowq = multiprocessing.Queue()
-    logging.info("Connected to Master")
-    while True:
+    def publish_events(self):
+        """ Send on everything the render loop has posted """
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except OSError:
+            pass
+        while self.events:
+            event = self.events.popleft()
+            if event["event"] == "loaded":
+                self.preloaded(event)
+            else:
+                self.publish(event)
+
+    def preloaded(self, event):
+        """ Answer the preload requests for an image the render loop has """
+        for conn, msgid in self.preloads.pop(event["image"], []):
+            if conn.sock in self.connections:
+                conn.send(protocol.REPLY, msgid, {"loaded": event["loaded"]})
+
+    def publish(self, event):
+        """ Record a change of state and tell every connected server """
+        self.state.update((key, value) for key, value in event.items()
+                          if key != "event")
+        for conn in list(self.connections.values()):
+            if conn.greeted:
+                conn.send(protocol.EVENT, 0, event)
+
+    def stop(self):
+        """ Stop the event loop and wait for it to close its connections """
+        self.running = False
+        self.wake()
+        self.worker.join(1)
+
+    def close(self):
+        self.slideshow.stop()
+        for conn in list(self.connections.values()):
+            print("Close connnection %s" % str(conn.address))
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.drop(conn)
+        self.listener.close()
 
-        # buffer size is 1024 bytes
-        data = recv_msg(connection)
 
-        if data != "alive":
-            try:
-                data = pickle.loads(data)
-                logging.debug(data)
-            except TypeError, e:
-                logging.exception("Failed to unpickle data")
-
-            logging.info("Received TCP data: %s from %s" % (data, client_address))
-
-            if slideshowon is True:
-                # If slideshow is running, kill it
-                logging.info("Tell Slideshow process to die")
-                # Tell slideshow to die
-                killslideshowq.put("die")
-                slideshowon = False
-
-            if data["action"] == "project":
-                if "images" in data:
-                    cur_queue.put(data["images"][0])
-                    slideshowon = False
-                elif "video" in data:
-                    logging.info("Video to project is %s", data["video"])
-                else:
-                    logging.info("Nothing to project")
-            elif data["action"] == "slideshow":
-                logging.info("Start Slideshow Process")
-                ssproc = multiprocessing.Process(target=slideshow,
-                                                 args=(data["images"],
-                                                       cur_queue,
-                                                       killslideshowq))
-                ssproc.start()
-                slideshowon = True
-            elif data["action"] == "stopslideshow":
-                ssproc.terminate()
-            elif data["action"] == "sync":
-                images = list_files(IMAGEDIR)
-                print(images)
-            elif data["action"] == "whatsplaying":
-                settings = read_settings(process)
-                send_msg(connection, settings["lastimage"])
-            else:
-                logging.info("Unkown action: %s", data["action"])
-        else:
-            logging.info("Alive?")
-            send_msg(connection, "alive")
+""" pi3d """
 
 
-def tcp_receiver(cur_queue, connections):
-    """ Receive images via TCP """
-    process = "TCP Receiver"
+def texture_bytes(texture, mipmap=True):
+    """ Estimate the GPU memory used by a texture """
+    size = texture.ix * texture.iy * 4
+    if mipmap is True:
+        # A full mipmap chain adds roughly a third again
+        size += size // 3
+    return size
 
-    # TCP config
-    tcp_ip = "127.0.0.1"  # local only
-    tcp_port = 5006
 
-    # Set up TCP
-    # Create a TCP/IP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def decode_image(image, width, height):
+    """ Decode an image to pixels no bigger than the display """
+    img = Image.open(image).convert('RGBA')
+    # Shrink with the CPU now rather than uploading pixels we can't show
+    img.thumbnail((width, height), Image.ANTIALIAS)
+    return numpy.array(img)
 
-    logging.info('Starting up on %s port %s' % (tcp_ip, tcp_port))
 
-    # bind server to address
-    sock.bind((tcp_ip, tcp_port))
-    sock.listen(1)
+def frame_number(filename):
+    """ Sort key for numbered frames, frame_10.png comes after frame_9.png """
+    digits = re.findall(r'\d+', filename)
+    return (int(digits[-1]) if digits else 0, filename)
 
-    cons = {}
 
-    while True:
-        logging.info("Waiting for a connection...")
-        # Not sure if this is really necessary however,
-        # It gives the connection a unique number
-        # and adds it to the connactions dictionary
-        con_number = str(len(connections) + 1)
-        logging.debug(con_number)
-        cons[con_number], client_address = sock.accept()
+def decode_frames(source, width, height):
+    """ Yield (pixels, seconds to show them) for each frame of an animation
 
-        logging.info("Starting a new thread for client %s", str(client_address))
-        thread.start_new_thread(client_handler, (cons[con_number],
-                                client_address, cur_queue))
+    source is an animated GIF or PNG, or a folder of numbered frames played
+    at sequencefps. Every frame is the size of the first, so they can all
+    be uploaded into the same textures. """
+    size = None
+    if os.path.isdir(source):
+        delay = 1 / SETTINGS.get("sequencefps", 25)
+        frames = (Image.open(os.path.join(source, filename)) for filename in
+                  sorted(list_files(source), key=frame_number))
+    else:
+        delay = None
+        frames = ImageSequence.Iterator(Image.open(source))
+
+    for frame in frames:
+        # GIFs that say 0 are shown at 10 fps by browsers, so here too
+        duration = delay or frame.info.get("duration", 100) / 1000 or 0.1
+        frame = frame.convert('RGBA')
+        if size is None:
+            frame.thumbnail((width, height), Image.ANTIALIAS)
+            size = frame.size
+        elif frame.size != size:
+            frame = frame.resize(size, Image.ANTIALIAS)
+        yield numpy.array(frame), duration
+
+
+class FrameSource(object):
+    """ Decode an animation a few frames ahead of the render loop
+
+    The queue is bounded, so the decoder waits for the render loop and
+    memory stays the same however long the animation is. It loops for as
+    long as it is open. """
+    def __init__(self, source, width, height, ahead=FRAMES_AHEAD):
+        self.source = source
+        self.width = width
+        self.height = height
+        self.frames = Queue.Queue(maxsize=ahead)
+        self.closed = threading.Event()
+        self.failed = False
+
+        worker = threading.Thread(target=self.run, name="FrameSource")
+        worker.daemon = True
+        worker.start()
+
+    def run(self):
+        while not self.closed.is_set():
+            decoded = 0
+            try:
+                start = time.time()
+                for frame in decode_frames(self.source, self.width,
+                                           self.height):
+                    DECODE_TIME.observe(time.time() - start, kind="frame")
+                    decoded += 1
+                    if not self.put(frame):
+                        return
+                    start = time.time()
+            except (IOError, ValueError, EOFError):
+                logging.exception("Failed to decode %s", self.source)
+            if decoded == 0:
+                self.failed = True
+                return
+
+    def put(self, frame):
+        """ Wait for room for a frame, returns False once closed """
+        while not self.closed.is_set():
+            try:
+                self.frames.put(frame, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def next(self):
+        """ Return the next (pixels, seconds), or None if it isn't ready """
+        try:
+            return self.frames.get_nowait()
+        except Queue.Empty:
+            return None
 
+    def close(self):
+        self.closed.set()
+
+
+class Animation(object):
+    """ An animation playing into a ring of textures
+
+    Each frame is uploaded into the oldest texture in the ring rather than
+    a new one, so the GPU memory used never grows. Frames are shown for as
+    long as the source says. If the decoder falls behind, timing starts
+    again from the late frame rather than rushing to catch up. """
+    def __init__(self, source, width, height):
+        self.source = FrameSource(source, width, height)
+        self.ring = []
+        self.slot = -1
+        self.texture = None
+        self.next_due = None
+        # Frames shown, and times the decoder wasn't ready with one
+        self.shown = 0
+        self.stalls = 0
+
+    def ready(self):
+        """ Whether the first frame is ready to show """
+        return self.texture is not None or self.advance(time.time())
+
+    def advance(self, now):
+        """ Move on to the next frame if it is due, returns if it did """
+        if self.next_due is not None and now < self.next_due:
+            return False
+        frame = self.source.next()
+        if frame is None:
+            if self.texture is not None:
+                self.stalls += 1
+                ANIMATION_STALLS.inc()
+            return False
+
+        pixels, duration = frame
+        self.slot = (self.slot + 1) % FRAME_RING
+        start = time.time()
+        if len(self.ring) < FRAME_RING:
+            self.ring.append(pi3d.Texture(pixels, blend=True, mipmap=False))
+        else:
+            self.ring[self.slot].update_ndarray(pixels)
+        UPLOAD_TIME.observe(time.time() - start, kind="frame")
+        self.texture = self.ring[self.slot]
+        self.shown += 1
+
+        if self.next_due is None or now - self.next_due > duration:
+            # First frame, or too far behind to catch up
+            self.next_due = now + duration
+        else:
+            self.next_due += duration
+        return True
+
+    def bytes(self):
+        return FRAME_RING * texture_bytes(self.texture, mipmap=False)
+
+    def close(self):
+        logging.info("%s: %d frames shown, %d stalls", self.source.source,
+                     self.shown, self.stalls)
+        self.source.close()
+        self.ring = []
+        self.texture = None
+
+
+class TextureLoader(object):
+    """ Decode images in a background thread
+
+    The render loop then only has to upload the pixels to the GPU,
+    so a fade in progress keeps running while an image loads. """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.requests = Queue.Queue()
+        self.ready = Queue.Queue()
+        self.pending = set()
+        # Loads given up on before or after decoding
+        self.cancelled = 0
+
+        worker = threading.Thread(target=self.run, name="TextureLoader")
+        worker.daemon = True
+        worker.start()
+
+    def request(self, image):
+        """ Ask for an image to be decoded """
+        if image not in self.pending:
+            self.pending.add(image)
+            self.requests.put(image)
+
+    def run(self):
+        """ Decode requested images, forever """
+        while True:
+            image = self.requests.get()
+            if image not in self.pending:
+                # Cancelled while it was waiting
+                continue
+            start = time.time()
+            try:
+                pixels = decode_image(image, self.width, self.height)
+                DECODE_TIME.observe(time.time() - start, kind="image")
+            except (IOError, ValueError):
+                logging.exception("Failed to decode %s", image)
+                pixels = None
+            self.ready.put((image, pixels))
+
+    def cancel(self, image):
+        """ Stop waiting for an image that is no longer wanted
+
+        It is skipped if it hasn't been started, and thrown away rather
+        than uploaded if it has. """
+        if image in self.pending:
+            self.pending.discard(image)
+            self.cancelled += 1
+
+    def collect(self):
+        """ Return one decoded (image, pixels) pair, or None """
+        while True:
+            try:
+                image, pixels = self.ready.get_nowait()
+            except Queue.Empty:
+                return None
+            if image in self.pending:
+                self.pending.discard(image)
+                return image, pixels
+
+
+class TextureCache(object):
+    """ Least recently used cache of loaded images, bounded by GPU memory
+
+    Entries are the dicts Carousel keeps for each image. Only entries that
+    have faded out completely are evicted, the focused image never is. """
+    def __init__(self, budget):
+        self.budget = budget  # bytes
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, image):
+        return image in self.entries
+
+    def __getitem__(self, image):
+        return self.entries[image]
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, image):
+        """ Return the entry for an image and mark it as recently used """
+        if image in self.entries:
+            self.hits += 1
+            # Move to the most recently used end
+            entry = self.entries.pop(image)
+            self.entries[image] = entry
+            return entry
+        self.misses += 1
+        return None
 
-""" pi3d """
+    def add(self, image, entry):
+        """ Add a newly loaded image """
+        self.entries[image] = entry
+        self.used += entry["bytes"]
+
+    def trim(self, focus):
+        """ Evict faded out images until the cache fits its budget """
+        for image in list(self.entries):
+            if self.used <= self.budget:
+                break
+            entry = self.entries[image]
+            if image == focus or entry["visible"] is True:
+                continue
+            self.release(image)
+            self.evictions += 1
+            logging.info("Evicted %s from texture cache", image)
+
+    def release(self, image):
+        """ Drop an image from the cache
+
+        pi3d frees the GL texture once the last reference to it goes, so
+        the texture must not be kept anywhere else """
+        entry = self.entries.pop(image)
+        self.used -= entry["bytes"]
+        entry["texture"] = None
+        if entry.get("animation") is not None:
+            entry["animation"].close()
+
+    def stats(self):
+        """ Cache counters, used to size the budget for each board """
+        return {"entries": len(self.entries), "used": self.used,
+                "budget": self.budget, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
 
 
 class Carousel(object):
     """ The main object """
-    def __init__(self):
-        # Start the image dictionary
-        self.imagedict = {}
+    def __init__(self, events=None):
         self.process = "Carousel"
+        # Called with each state change for the servers
+        self.events = events
 
         # Load the last image used
-        try:
-            # If there is a settings file, load most recent image
-            # Load the settings file
-
-            settings = read_settings(self.process)
-            # Add the image to the queue
-            logging.info("Last image: %s" % settings["lastimage"])
-            starting_image = settings["lastimage"]
-        except:
-            logging.exception("Failed to load settings file")
-            logging.info("Loading default image")
-            # Write new image to settings
-            settings = read_settings(self.process)
-            settings["lastimage"] = "static/images/logo.jpg"
-            write_settings(self.process, settings)
-            settings = read_settings(self.process)
-            # Load default image into queue
-            starting_image = settings["lastimage"]
+        starting_image = SETTINGS["lastimage"]
+        logging.info("Last image: %s" % starting_image)
+
+        # Start the image dictionary, budget is in megabytes
+        budget = SETTINGS.get("texturecache", {}).get("budget", 48)
+        self.imagedict = TextureCache(budget * 1024 * 1024)
 
         # Set up image one
         texture_one = pi3d.Texture(starting_image, blend=True, mipmap=True)
-        image_one = pi3d.Canvas()
-        image_one.set_texture(texture_one)
-
-        width, height, x_position, y_position = fit_image(texture_one)
-
-        image_one.set_2d_size(w=width, h=height, x=x_position, y=y_position)
-        image_one.set_alpha(1)
-        image_one.set_shader(SHADER)
-        image_one.positionZ(0.1)
-
-        self.imagedict[starting_image] = {"canvas": image_one, "visible": True,
-                                          "fading": True}
+        self.imagedict.add(starting_image, self.entry(texture_one))
+        self.imagedict[starting_image]["visible"] = True
 
         self.focus = starting_image
-
-        # print(self.imagedict[self.focus]["canvas"].z())
-
-    def pick(self, new_image):
-        """ Pick an image by URL """
+        # Image fading out, and when the fade started
+        self.previous = None
+        self.fade_start = None
+        self.easing = EASINGS["linear"]
+        # How far the fade has got, 0 is all previous and 1 all focus
+        self.blend = 1.0
+
+        # One canvas covers the screen, the shader mixes the two images.
+        # set_2d_size gives the shader the screen size, in unif[15]
+        self.canvas = pi3d.Canvas()
+        self.canvas.set_2d_size(w=DISPLAY.width, h=DISPLAY.height, x=0, y=0)
+        self.canvas.set_shader(BLEND)
+        self.canvas.positionZ(0.1)
+
+        # Image waiting for the loader before it can be switched to
+        self.pending = None
+        # Animation waiting for its first frame, when that is what's pending
+        self.starting = None
+        # (image, time) to switch to an image on the frame nearest a time
+        self.scheduled = None
+        # Images the servers are waiting to hear are loaded, see preload
+        self.preloading = set()
+        # Whether anything changed in the last update
+        self.moving = True
+        # When the focused image was due, until its first frame is drawn
+        self.due = None
+        self.latency = {"count": 0, "total": 0.0, "max": 0.0}
+        self.loader = TextureLoader(DISPLAY.width, DISPLAY.height)
+
+    def entry(self, texture):
+        """ Cache entry for a newly loaded texture """
+        width, height, x_position, y_position = fit_image(texture)
+        return {"texture": texture, "bytes": texture_bytes(texture),
+                # How much of the screen the image fills, for the shader
+                "scale": (width / DISPLAY.width, height / DISPLAY.height),
+                "visible": False}
+
+    def pick(self, new_image, due=None):
+        """ Pick an image by URL
+
+        due is when the image should have been shown, used to measure how
+        late the first frame of it is """
+
+        # Anything picked since replaces a scheduled switch
+        self.scheduled = None
 
         if self.focus != new_image:
-            # Check to see if image already in dictionary
-            # Might be worth pre-preparing
-            # a dictionary with null canvas objects?
-
-            # If image is already loaded, make it visible
-            if new_image in self.imagedict:
-                # print("Image exists")
-                # New focus image is visible
-                self.imagedict[new_image]["visible"] = True
-
-                # New focus image is the active fader
-                self.imagedict[new_image]["fading"] = True
-
-                # Otherwise load it as a new image
+            self.due = due
+            # If image is already loaded, switch to it straight away
+            if self.imagedict.get(new_image) is not None:
+                self.cancel_pending()
+                self.switch(new_image)
+            # Otherwise decode it in the background and switch once ready
             else:
-                # print("Load new image")
-
-                new_canvas = pi3d.Canvas()
-
-                # print("Pick an image: %s" % new_image)
-                new_texture = pi3d.Texture(new_image, blend=True, mipmap=True)
-                # print("Texture loaded")
-                new_canvas.set_texture(new_texture)
-                # print("Texture set")
-
-                # Fit image
-                width, height, x_position, y_position = fit_image(new_texture)
-
-                new_canvas.set_2d_size(w=width, h=height,
-                                       x=x_position, y=y_position)
-                new_canvas.set_alpha(0)
-                new_canvas.set_shader(SHADER)
-                new_canvas.positionZ(0.2)
-                # print("New image prepared")
-
-                self.imagedict[new_image] = {"canvas": new_canvas,
-                                             "visible": True, "fading": True}
-
-            # Move old focused image back
-
-            if self.imagedict[self.focus]["canvas"].z() > 0.1:
-                self.imagedict[self.focus]["canvas"].positionZ(0.1)
-
-            # Bring new focused image forward
-            self.imagedict[new_image]["canvas"].positionZ(0.2)
-
-            # Old focus image not the active fader
-            self.imagedict[self.focus]["fading"] = False
-
-            self.focus = new_image  # Change the focused image
-            # Write new image to settings
-            settings = read_settings(self.process)
-            settings["lastimage"] = new_image
-            write_settings(self.process, settings)
-            settings = read_settings(self.process)
+                logging.info("Loading %s in the background", new_image)
+                if self.pending != new_image:
+                    # Superseded before it loaded, don't keep the loader busy
+                    self.cancel_pending()
+                self.pending = new_image
+                self.loader.request(new_image)
+        elif self.pending is not None:
+            # Back to the image on screen before the other one loaded
+            self.cancel_pending()
+            self.due = None
         else:
             logging.warning("Image already projected")
 
-    def update(self):
-        """ Update image alphas """
-        for image in self.imagedict:
-            alpha = self.imagedict[image]["canvas"].alpha()
-            if self.imagedict[image]["fading"] is True and alpha < 1:
-                # print("%s Increase alpha: %f" % (image, alpha))
-                alpha += alpha_step
-                self.imagedict[image]["canvas"].set_alpha(alpha)
-            elif self.imagedict[image]["fading"] is False and alpha > 0:
-                # print("%s Decrease alpha: %f" % (image, alpha))
-                alpha -= alpha_step
-                self.imagedict[image]["canvas"].set_alpha(alpha)
+    def play(self, source, due=None):
+        """ Pick an animation, switched to once its first frame is ready """
+        self.scheduled = None
+
+        if self.focus == source:
+            logging.warning("Animation already playing")
+        elif self.imagedict.get(source) is not None:
+            self.due = due
+            self.cancel_pending()
+            self.switch(source)
+        elif self.pending != source:
+            logging.info("Starting %s in the background", source)
+            self.due = due
+            self.cancel_pending()
+            self.pending = source
+            self.starting = Animation(source, DISPLAY.width, DISPLAY.height)
+
+    def cancel_pending(self):
+        """ Give up on the image waiting to be switched to """
+        if self.starting is not None:
+            self.starting.close()
+            self.starting = None
+        elif self.pending is not None and self.pending not in self.preloading:
+            self.loader.cancel(self.pending)
+        self.pending = None
+
+    def schedule(self, new_image, at):
+        """ Pick an image on the frame nearest a time """
+        self.scheduled = (new_image, at)
+        # Have it on the GPU by then
+        self.prefetch([new_image])
+
+    def tick(self):
+        """ Make a scheduled switch if this is the nearest frame to it """
+        if self.scheduled is None:
+            return
+        new_image, at = self.scheduled
+        # Half a frame early is nearer than half a frame late
+        if time.time() + FRAMETIME / 2 >= at:
+            if (new_image != self.focus and
+                    self.imagedict.get(new_image) is None):
+                # It will switch whenever it has loaded, out of step with
+                # the rest of its group
+                logging.warning("Switch to %s due before it was loaded",
+                                new_image)
+                SCHEDULED_UNLOADED.inc()
+            self.pick(new_image, at)
+
+    def prefetch(self, images):
+        """ Start loading images that will be picked soon """
+        for image in images:
+            if image != self.focus and image not in self.imagedict:
+                self.loader.request(image)
+
+    def preload(self, images):
+        """ Load images and tell the servers when each one is on the GPU
+
+        For group switches, the servers only schedule the switch once
+        every display has the image loaded. """
+        for image in images:
+            if image == self.focus or image in self.imagedict:
+                self.notify({"event": "loaded", "image": image,
+                             "loaded": True})
             else:
-                if alpha <= 0:
-                    self.imagedict[image]["visible"] = False
-
-    def draw(self):
-        """ Draw the images on the screen """
-        # Draw fading image first
-        first_image = None
-        second_image = None
+                self.preloading.add(image)
+                self.loader.request(image)
+
+    def resolve_preload(self, image, loaded):
+        """ Tell the servers a preloaded image is on the GPU, or failed """
+        if image in self.preloading:
+            self.preloading.discard(image)
+            self.notify({"event": "loaded", "image": image, "loaded": loaded})
+
+    def collect(self):
+        """ Upload the next decoded image to the GPU """
+        if self.starting is not None:
+            self.collect_animation()
+
+        loaded = self.loader.collect()
+        if loaded is None:
+            return
+
+        new_image, pixels = loaded
+        if pixels is None:
+            logging.error("Could not load %s", new_image)
+            self.resolve_preload(new_image, False)
+            if self.pending == new_image:
+                self.pending = None
+                self.due = None
+            return
+
+        if new_image not in self.imagedict:
+            start = time.time()
+            new_texture = pi3d.Texture(pixels, blend=True, mipmap=True)
+            UPLOAD_TIME.observe(time.time() - start, kind="image")
+            self.imagedict.add(new_image, self.entry(new_texture))
+            logging.info("Texture cache: %s", self.imagedict.stats())
+        self.resolve_preload(new_image, True)
+
+        if self.pending == new_image:
+            self.pending = None
+            self.switch(new_image)
+
+    def collect_animation(self):
+        """ Switch to the animation being started once it can be shown """
+        animation = self.starting
+        if animation.source.failed:
+            logging.error("Could not play %s", self.pending)
+            self.cancel_pending()
+            self.due = None
+        elif animation.ready():
+            entry = self.entry(animation.texture)
+            entry.update(animation=animation, bytes=animation.bytes())
+            self.imagedict.add(self.pending, entry)
+            new_image = self.pending
+            self.starting = None
+            self.pending = None
+            self.switch(new_image)
+
+    def switch(self, new_image):
+        """ Start fading to an image that is already loaded """
+        # New focus image is visible
+        self.imagedict[new_image]["visible"] = True
+
+        # Picked again mid-fade, the image fading out is cut
+        if self.previous is not None and self.previous != new_image:
+            self.imagedict[self.previous]["visible"] = False
+
+        # Old focus image fades out
+        self.previous = self.focus
+        self.focus = new_image  # Change the focused image
+        self.fade_start = time.time()
+        self.blend = 0.0
+        if self.due is not None:
+            # Scheduled switches can start up to half a frame early
+            FADE_DELAY.observe(max(self.fade_start - self.due, 0))
+        easing = SETTINGS.get("fadeeasing", "linear")
+        if easing not in EASINGS:
+            logging.warning("Unknown fade easing %s, using linear", easing)
+        self.easing = EASINGS.get(easing, EASINGS["linear"])
+
+        self.imagedict.trim(self.focus)
+        self.notify({"event": "focus", "image": new_image, "fading": True})
+        # Remembered for next time, written out in the background
+        SETTINGS.set("lastimage", new_image)
+
+    def notify(self, event):
+        """ Tell the servers what has changed """
+        if self.events is not None:
+            self.events(event)
 
-        for image in self.imagedict:
-            if self.imagedict[image]["visible"] is True and self.imagedict[image]["fading"] is True:
-                first_image = self.imagedict[image]["canvas"]
-            elif self.imagedict[image]["visible"] is True:
-                second_image = self.imagedict[image]["canvas"]
+    def update(self):
+        """ Move the fade on by however long it has been running """
+        self.moving = False
+        now = time.time()
+        for image in (self.focus, self.previous):
+            if not image:
+                continue
+            animation = self.imagedict[image].get("animation")
+            if animation is not None and animation.advance(now):
+                self.imagedict[image]["texture"] = animation.texture
+                self.moving = True
+
+        if self.previous is None:
+            return
+        self.moving = True
+
+        duration = SETTINGS["fadeduration"]
+        elapsed = time.time() - self.fade_start
+        if duration > 0 and elapsed < duration:
+            self.blend = self.easing(elapsed / duration)
+            return
+
+        # Fade finished, the image faded out can make room for new ones
+        self.blend = 1.0
+        self.imagedict[self.previous]["visible"] = False
+        self.previous = None
+        self.imagedict.trim(self.focus)
+        self.notify({"event": "faded", "image": self.focus, "fading": False})
+
+    def idle(self):
+        """ Whether the next frame would look the same as the last one """
+        return (not self.moving and self.pending is None and
+                self.imagedict[self.focus].get("animation") is None and
+                self.scheduled is None and self.due is None and
+                not self.loader.pending)
 
-        first_image.draw()
-        # If second image exists (fixes start up)
-        if second_image:
-            second_image.draw()
+    def draw(self):
+        """ Draw the images on the screen, in one pass """
+        focus = self.imagedict[self.focus]
+        previous = self.imagedict[self.previous or self.focus]
+        self.canvas.set_draw_details(BLEND, [focus["texture"],
+                                             previous["texture"]])
+        # unif[16] to unif[18] in the shader
+        self.canvas.set_custom_data(48, [self.blend, 0.0, 0.0])
+        self.canvas.set_custom_data(51, [focus["scale"][0],
+                                         focus["scale"][1], 0.0])
+        self.canvas.set_custom_data(54, [previous["scale"][0],
+                                         previous["scale"][1], 0.0])
+        self.canvas.draw()
+
+        # First frame of a newly picked image
+        if self.due is not None and self.pending is None:
+            latency = time.time() - self.due
+            self.due = None
+            self.latency["count"] += 1
+            self.latency["total"] += latency
+            self.latency["max"] = max(self.latency["max"], latency)
+            VISIBLE_DELAY.observe(max(latency, 0))
+            logging.info("%s visible %.3fs after it was due", self.focus,
+                         latency)
+
+
+def render_stats():
+    """ How much drawing idling has saved """
+    elapsed = time.time() - RENDERSTATS["start"]
+    cpu = sum(os.times()[:2]) - RENDERSTATS["cpu"]
+    # Frames that would have been drawn without idling
+    skipped = int(RENDERSTATS["idle"] * FPS)
+    per_frame = cpu / RENDERSTATS["frames"] if RENDERSTATS["frames"] else 0
+    return {"frames": RENDERSTATS["frames"], "skipped": skipped,
+            "idle": RENDERSTATS["idle"] / elapsed if elapsed else 0,
+            "cpu": cpu, "cpu_saved": skipped * per_frame}
+
+
+def collect_metrics():
+    """ Copy counts kept by the render loop into METRICS """
+    cache = crsl.imagedict.stats()
+    CACHE_BYTES.set(cache["used"])
+    CACHE_BUDGET.set(cache["budget"])
+    CACHE_ENTRIES.set(cache["entries"])
+    CACHE_LOOKUPS.set(cache["hits"], result="hit")
+    CACHE_LOOKUPS.set(cache["misses"], result="miss")
+    CACHE_EVICTIONS.set(cache["evictions"])
+    LOADS_CANCELLED.set(crsl.loader.cancelled)
+    for result, count in CONTROL.commands.stats().items():
+        COMMANDS.set(count, result=result)
+    QUEUE_DEPTH.set(len(CONTROL.commands), queue="commands")
+    QUEUE_DEPTH.set(len(CONTROL.events), queue="events")
+    QUEUE_DEPTH.set(crsl.loader.requests.qsize(), queue="decode")
+    QUEUE_DEPTH.set(crsl.loader.ready.qsize(), queue="upload")
+    FRAMES.set(RENDERSTATS["frames"])
+    IDLE.set(RENDERSTATS["idle"])
+
+
+def handle_key(k):
+    """ Act on a key press from the render loop """
+    if k == 27:
+        logging.info("Texture cache: %s", crsl.imagedict.stats())
+        logging.info("Due to visible: %s", crsl.latency)
+        logging.info("Commands: %s, loads cancelled: %d",
+                     CONTROL.commands.stats(), crsl.loader.cancelled)
+        logging.info("Render: %s", render_stats())
+        KEYBOARD.close()
+        DISPLAY.stop()
+        CONTROL.stop()
+        SETTINGS.flush()
 
 
 if __name__ == "__main__":
@@ -407,34 +1439,49 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--test",
                         help="Run projector in a window for testing",
                         action="store_true")
+    parser.add_argument("--headless",
+                        help="Run without a screen or GPU, nothing is shown",
+                        action="store_true")
 
     args = parser.parse_args()
-
-    # Set up image queue
-    IMAGEQ = multiprocessing.Queue()
-
-    # Set up connections dict
-    connections = multiprocessing.Manager().dict()
-
-    logging.info("Start TCP Receiver")
-    tcpprocess = multiprocessing.Process(target=tcp_receiver,
-                                         args=(IMAGEQ, connections))
-    tcpprocess.start()
+    if args.headless:
+        # Same render loop, drawing nothing, see headless.py
+        pi3d = headless
+    elif pi3d is None:
+        parser.error("pi3d is not installed, only --headless can run")
+
+    # Settings are kept in memory and written back in the background
+    SETTINGS = settingsstore.SettingsStore('settings.yml', DEFAULTS)
+    SETTINGS.start()
+
+    # One thread serves every server connection
+    logging.info("Start Control Server")
+    # Servers anywhere on the network can connect, unless set otherwise
+    control = SETTINGS.get("control", {})
+    CONTROL = ControlServer((control.get("host", "0.0.0.0"),
+                             control.get("port", 5006)))
+    CONTROL.start()
 
     logging.info("Start Projector process")
 
     if args.test:
         # If testing, create a small display
         DISPLAY = pi3d.Display.create(background=(0.0, 0.0, 0.0, 1.0),
-                                      frames_per_second=20, w=800, h=600)
+                                      frames_per_second=FPS, w=800, h=600)
     else:
         DISPLAY = pi3d.Display.create(background=(0.0, 0.0, 0.0, 1.0),
-                                      frames_per_second=20)
+                                      frames_per_second=FPS)
+
+    CONTROL.displayinfo.update(width=DISPLAY.width, height=DISPLAY.height)
 
-    SHADER = pi3d.Shader("2d_flat")
+    # Let servers find us without being told our address
+    if SETTINGS.get("discovery", {}).get("announce", True) is True:
+        ANNOUNCER = discovery.Announcer(CONTROL.announcement)
+        ANNOUNCER.start()
 
-    alpha_step = 0.025
-    crsl = Carousel()
+    # Crossfades both images in one draw, see shaders/blend.fs
+    BLEND = pi3d.Shader("shaders/blend")
+    crsl = Carousel(CONTROL.post_event)
 
     # Set up camera
     CAMERA = pi3d.Camera.instance()
@@ -443,25 +1490,52 @@ if __name__ == "__main__":
     # Keyboard
     KEYBOARD = pi3d.Keyboard()
 
+    # Frames drawn and seconds spent not drawing, to see what idling saves
+    RENDERSTATS = {"frames": 0, "idle": 0.0, "start": time.time(),
+                   "cpu": sum(os.times()[:2]),
+                   "report": time.time() + RENDER_REPORT}
+    METRICS.add_collector(collect_metrics)
+
     while DISPLAY.loop_running():
+        frame_start = time.time()
+        crsl.tick()
+        crsl.collect()
         crsl.update()
         crsl.draw()
+        FRAME_TIME.observe(time.time() - frame_start)
+
+        RENDERSTATS["frames"] += 1
 
         # Take keyboard events and check for quit
-        k = KEYBOARD.read()
-        if k > -1:
-            if k == 27:
-                KEYBOARD.close()
-                DISPLAY.stop()
-                if len(connections) > 0:
-                    for connection in connections:
-                        print("Close connnection %s" % connection)
-                        connection.shutdown(socket.SHUT_RDWR)
-                        connection.close()
-                tcpprocess.terminate()
+        handle_key(KEYBOARD.read())
 
         # Check if there is a new image to be displayed
-        if not IMAGEQ.empty():
-            new_image = IMAGEQ.get()
-            logging.info("New image is: %s", new_image)
-            crsl.pick(new_image)
+        for command in CONTROL.commands.take():
+            if command["action"] == "show" and command.get("at"):
+                logging.info("New image is: %s at %.3f", command["image"],
+                             command["at"])
+                crsl.schedule(command["image"], command["at"])
+            elif command["action"] == "show" and command.get("animation"):
+                logging.info("New animation is: %s", command["image"])
+                crsl.play(command["image"], command["due"])
+            elif command["action"] == "show":
+                logging.info("New image is: %s", command["image"])
+                crsl.pick(command["image"], command["due"])
+            elif command["action"] == "prefetch":
+                crsl.prefetch(command["images"])
+            elif command["action"] == "preload":
+                crsl.preload(command["images"])
+
+        # Nothing changed this frame, so the one on screen is what would be
+        # drawn next. Stop drawing until a command or key press arrives.
+        if crsl.idle() and not CONTROL.commands and DISPLAY.is_running:
+            idle_since = time.time()
+            while not CONTROL.commands and DISPLAY.is_running:
+                CONTROL.commands.wakeup.wait(IDLE_TICK)
+                CONTROL.commands.wakeup.clear()
+                handle_key(KEYBOARD.read())
+            RENDERSTATS["idle"] += time.time() - idle_since
+
+        if time.time() >= RENDERSTATS["report"]:
+            RENDERSTATS["report"] = time.time() + RENDER_REPORT
+            logging.info("Render: %s", render_stats())
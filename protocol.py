@@ -0,0 +1,276 @@
+""" Projectr - Control protocol shared by the Server and Projector Processes
+
+Every frame is a 4-byte length (network byte order) followed by
+
+    version  1 byte   VERSION, frames from other versions are refused
+    kind     1 byte   HELLO, REQUEST, REPLY, ERROR, EVENT or DATA
+    id       4 bytes  request id, replies and data carry their request's id
+
+and a body. DATA bodies are raw bytes, every other body is compact JSON.
+
+A connection starts with each end sending HELLO. After that the server
+sends REQUESTs, {"action": ..., ...}, and the projector answers each one
+with a REPLY or ERROR carrying the same id, so several requests can be in
+flight on one socket. DATA frames carry a file for the request with their
+id, and EVENTs are sent by the projector without being asked.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import itertools
+import json
+import socket
+import struct
+import threading
+import time
+
+VERSION = 1
+
+# Frame kinds
+HELLO = 1
+REQUEST = 2
+REPLY = 3
+ERROR = 4
+EVENT = 5
+DATA = 6
+
+LENGTH = struct.Struct('>I')
+HEADER = struct.Struct('>BBI')
+
+# Largest frame accepted, a little over the biggest file chunk
+MAXFRAME = 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """ The other end sent something this version doesn't understand """
+
+
+class RemoteError(Exception):
+    """ The other end could not handle a request """
+
+
+class ChannelClosed(socket.error):
+    """ The connection went away before the reply arrived """
+
+
+def encode(kind, msgid, body=None):
+    """ Make a frame """
+    if kind != DATA:
+        body = json.dumps(body, separators=(',', ':')).encode('utf-8')
+    return (LENGTH.pack(HEADER.size + len(body)) +
+            HEADER.pack(VERSION, kind, msgid) + body)
+
+
+def decode(frame):
+    """ Split a frame, without its length, into kind, id and body """
+    version, kind, msgid = HEADER.unpack(frame[:HEADER.size])
+    if version != VERSION:
+        raise ProtocolError("Protocol version %d, expected %d" %
+                            (version, VERSION))
+    body = frame[HEADER.size:]
+    if kind != DATA:
+        try:
+            body = json.loads(body.decode('utf-8'))
+        except ValueError as e:
+            raise ProtocolError("Bad frame body: %s" % e)
+    return kind, msgid, body
+
+
+def send_frame(sock, kind, msgid, body=None):
+    """ Send one frame """
+    sock.sendall(encode(kind, msgid, body))
+
+
+def recv_frame(sock):
+    """ Read one frame, returns (kind, id, body) or None if EOF is hit """
+    raw_length = recvall(sock, LENGTH.size)
+    if raw_length is None:
+        return None
+    length = LENGTH.unpack(raw_length)[0]
+    if length < HEADER.size or length > MAXFRAME:
+        raise ProtocolError("Bad frame length %d" % length)
+    frame = recvall(sock, length)
+    if frame is None:
+        return None
+    return decode(frame)
+
+
+def read_frames(buf):
+    """ Take every complete frame off the front of a bytearray
+
+    For event loops that read whatever has arrived into a buffer. Returns
+    a list of (kind, id, body). """
+    frames = []
+    while len(buf) >= LENGTH.size:
+        length = LENGTH.unpack_from(buf)[0]
+        if length < HEADER.size or length > MAXFRAME:
+            raise ProtocolError("Bad frame length %d" % length)
+        if len(buf) < LENGTH.size + length:
+            break
+        frames.append(decode(bytes(buf[LENGTH.size:LENGTH.size + length])))
+        del buf[:LENGTH.size + length]
+    return frames
+
+
+def recvall(sock, n):
+    """ Helper function to recv n bytes or return None if EOF is hit """
+    chunks = []
+    received = 0
+    while received < n:
+        packet = sock.recv(min(n - received, 65536))
+        if not packet:
+            return None
+        chunks.append(packet)
+        received += len(packet)
+    return b''.join(chunks)
+
+
+def check_hello(frame):
+    """ Check the first frame from the other end is a HELLO we can talk to """
+    if frame is None:
+        raise ChannelClosed("Connection closed during handshake")
+    kind, msgid, body = frame
+    if kind != HELLO:
+        raise ProtocolError("Expected HELLO, got frame kind %d" % kind)
+    if not isinstance(body, dict):
+        raise ProtocolError("HELLO body is not an object")
+    if body.get("version") != VERSION:
+        raise ProtocolError("Peer speaks version %s" % body.get("version"))
+    return body
+
+
+class Pending(object):
+    """ A request waiting for its reply """
+    def __init__(self, msgid):
+        self.id = msgid
+        self.done = threading.Event()
+        self.reply = None
+        self.error = None
+        # When the request went and its reply came, for round trip times
+        self.sent = None
+        self.received = None
+
+    def resolve(self, reply=None, error=None):
+        self.received = time.time()
+        self.reply = reply
+        self.error = error
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """ Wait for the reply and return it """
+        if not self.done.wait(timeout):
+            raise socket.timeout("No reply to request %d" % self.id)
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+
+class Channel(object):
+    """ Server end of a control connection to a projector
+
+    Requests are pipelined, a reader thread hands each reply to the
+    request with the same id, so several threads can share the channel. """
+    def __init__(self, address, timeout=1, hello=None, on_event=None):
+        self.address = tuple(address)
+        self.on_event = on_event
+        self.ids = itertools.count(1)
+        self.pending = {}
+        self.closed = False
+        # Only one thread may write a frame at a time
+        self.lock = threading.Lock()
+
+        self.sock = socket.create_connection(address, timeout)
+        # A request and its DATA frames are separate writes, don't let
+        # Nagle hold one back waiting for the projector's ACK
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            body = dict(hello or {}, version=VERSION)
+            send_frame(self.sock, HELLO, 0, body)
+            # What the projector tells us about itself
+            self.info = check_hello(recv_frame(self.sock))
+        except Exception:
+            self.sock.close()
+            raise
+        self.sock.settimeout(None)
+
+        reader = threading.Thread(target=self.read,
+                                  name="Channel %s:%s" % self.address)
+        reader.daemon = True
+        reader.start()
+
+    def request_async(self, action, **params):
+        """ Send a request and return a Pending for its reply """
+        pending = Pending(next(self.ids))
+        self.pending[pending.id] = pending
+        params["action"] = action
+        try:
+            pending.sent = time.time()
+            self.send(REQUEST, pending.id, params)
+        except socket.error:
+            self.pending.pop(pending.id, None)
+            raise
+        if self.closed and self.pending.pop(pending.id, None) is not None:
+            # Closed after sending, the reader won't be resolving it
+            pending.resolve(error=ChannelClosed("Channel to %s:%s closed" %
+                                                self.address))
+        return pending
+
+    def request(self, action, timeout=20, **params):
+        """ Send a request and wait for its reply """
+        pending = self.request_async(action, **params)
+        try:
+            return pending.wait(timeout)
+        finally:
+            self.pending.pop(pending.id, None)
+
+    def send_data(self, msgid, chunk):
+        """ Send part of a file for the request with the given id """
+        self.send(DATA, msgid, chunk)
+
+    def send(self, kind, msgid, body):
+        if self.closed:
+            raise ChannelClosed("Channel to %s:%s is closed" % self.address)
+        frame = encode(kind, msgid, body)
+        with self.lock:
+            self.sock.sendall(frame)
+
+    def read(self):
+        """ Hand replies to their requests, until the connection closes """
+        error = ChannelClosed("Channel to %s:%s closed" % self.address)
+        try:
+            while True:
+                frame = recv_frame(self.sock)
+                if frame is None:
+                    break
+                kind, msgid, body = frame
+                if kind == EVENT:
+                    if self.on_event is not None:
+                        self.on_event(body)
+                    continue
+
+                pending = self.pending.pop(msgid, None)
+                if pending is None:
+                    # Whoever asked has given up waiting
+                    continue
+                if kind == REPLY:
+                    pending.resolve(reply=body)
+                elif kind == ERROR:
+                    pending.resolve(error=RemoteError(body.get("error")))
+                else:
+                    raise ProtocolError("Unexpected frame kind %d" % kind)
+        except (socket.error, ProtocolError, ValueError) as e:
+            error = ChannelClosed("Channel to %s:%s failed: %s" %
+                                  (self.address + (e,)))
+        finally:
+            self.close()
+            for msgid in list(self.pending):
+                self.pending.pop(msgid).resolve(error=error)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
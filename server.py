@@ -5,20 +5,26 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import web
 import os
+import json
+import hashlib
+import tempfile
+import multiprocessing
+import threading
+import time
+import math
+import collections
 from datetime import datetime
 from PIL import Image
 import random
-import yaml
 import sys
 import dbus
 # Networking
 import socket
-import pickle
-import struct
-
-# Set up TCP socket port 5005
-
-connections = {}
+import protocol
+import discovery
+import settingsstore
+import metrics
+import multipart
 
 # Set up URLS
 
@@ -31,7 +37,11 @@ urls = (
     '/rename', 'Rename',
     '/videos', 'Videos',
     '/displays', 'Displays',
+    '/jobs', 'Jobs',
+    '/jobs/(.+)', 'Jobs',
+    '/metrics', 'Metrics',
     '/display/(.+)', 'Index',
+    '/group/(.+)', 'Group',
     '/initnetwork', 'initNetwork'
 )
 
@@ -39,6 +49,7 @@ urls = (
 IMAGEDIR = 'static/images/'
 VIDEODIR = 'static/videos'
 THUMBDIR = 'static/images/thumbs'
+RENDITIONDIR = 'static/images/renditions'
 
 
 # Set up web.py app
@@ -48,13 +59,109 @@ app = web.application(urls, globals())
 render = web.template.render('templates/', base="layout")
 
 db = web.database(dbn="sqlite", db="images.db")
-# CREATE TABLE images(Id INTEGER PRIMARY KEY, filename TEXT, imagename TEXT, folder TEXT);
+# CREATE TABLE images(Id INTEGER PRIMARY KEY, filename TEXT, imagename TEXT,
+#                      folder TEXT, status TEXT DEFAULT 'ready');
 
 
 # Image size maximums
 WIDTH = 1920
 HEIGHT = 1080
 
+# Uploads are copied in chunks of this size
+UPLOADCHUNK = 64 * 1024
+
+# Display connections, in seconds
+CONNECT_TIMEOUT = 1
+KEEPALIVE = 5
+KEEPALIVE_TIMEOUT = 2
+MINBACKOFF = 1
+MAXBACKOFF = 60
+
+# Clock sync, keepalives are timed to estimate each display's clock
+CLOCKSAMPLES = 8
+# Round trips timed straight after connecting
+CLOCKBURST = 4
+# How far ahead a synchronised switch is scheduled, once every display in
+# the group has the image loaded, and how long to wait for them to load it.
+# Both can be set in settings.yml, groups: {lead: ..., preloadtimeout: ...}
+SWITCH_LEAD = 0.5
+PRELOAD_TIMEOUT = 20
+
+# Animations the projectors can play, besides folders of numbered frames
+ANIMATIONTYPES = ('.gif', '.png', '.apng')
+
+# Slideshow requests that take no arguments
+SLIDESHOWCONTROLS = ('pauseslideshow', 'resumeslideshow', 'skipslideshow',
+                     'stopslideshow')
+
+# Fade curves the projectors know
+FADEEASINGS = ('linear', 'ease-in', 'ease-out', 'ease-in-out')
+
+# Images are streamed to displays in chunks of this size
+PUSHCHUNK = 64 * 1024
+
+# Images each display is known to have
+PUSHED = {}
+
+# Magic bytes of the image formats that can be uploaded
+IMAGEMAGIC = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+)
+
+# Thumbnail widths for the web UI
+THUMBSIZES = (320, 640, 960)
+
+# Processes that resize uploads and make thumbnails
+WORKERS = 2
+POOL = None
+
+# Upload jobs by filename, with the state of each
+JOBS = {}
+# Held while deciding whether an upload is new and recording it, and while
+# a job finishes, so identical uploads arriving together are queued once
+UPLOADLOCK = threading.Lock()
+
+# Seconds /metrics waits for the displays to send theirs
+METRICS_TIMEOUT = 2
+
+# Ours, the displays' are fetched for each /metrics, see metrics.py
+METRICS = metrics.Registry()
+UPLOAD_TIME = METRICS.histogram(
+    "projectr_upload_seconds", "Time to receive and store an upload")
+RESIZE_TIME = METRICS.histogram(
+    "projectr_resize_seconds",
+    "Time to resize an upload and make its renditions and thumbnails")
+UPLOADS = METRICS.counter(
+    "projectr_uploads_total", "Uploads by how they ended", ("result",))
+REQUEST_TIME = METRICS.histogram(
+    "projectr_display_request_seconds",
+    "Round trip time of requests to each display", ("display", "action"))
+REQUEST_FAILURES = METRICS.counter(
+    "projectr_display_request_failures_total",
+    "Requests to each display that failed or weren't answered",
+    ("display", "action"))
+# Kept elsewhere and copied in by collect_metrics
+DISPLAY_ONLINE = METRICS.gauge(
+    "projectr_display_online", "Whether each display is connected",
+    ("display",))
+RECONNECTS = METRICS.counter(
+    "projectr_display_reconnects_total",
+    "Times each display's connection was lost", ("display",))
+PENDING_REQUESTS = METRICS.gauge(
+    "projectr_display_pending_requests",
+    "Requests waiting for a reply from each display", ("display",))
+CLOCK_OFFSET = METRICS.gauge(
+    "projectr_display_clock_offset_seconds",
+    "How far each display's clock is ahead of ours", ("display",))
+UPLOAD_JOBS = METRICS.gauge(
+    "projectr_upload_jobs", "Upload jobs in each state", ("state",))
+
 """ Functions """
 
 
@@ -66,6 +173,28 @@ def db_list_images():
     return output
 
 
+def db_migrate():
+    """ Add columns missing from databases made by older versions """
+    columns = [column["name"] for column in
+               db.query("PRAGMA table_info(images)")]
+    if "status" not in columns:
+        # Images that are already there have been processed
+        db.query("ALTER TABLE images ADD COLUMN status TEXT DEFAULT 'ready'")
+
+
+def db_image_ready(filename):
+    """ Check an image has been processed and can be projected """
+    return db.query("SELECT COUNT(*) AS ready FROM images "
+                    "WHERE filename=$filename AND status='ready'",
+                    vars=locals())[0]["ready"] > 0
+
+
+def db_refcount(filename):
+    """ Count the catalog entries that use an image file """
+    return db.query("SELECT COUNT(*) AS refs FROM images "
+                    "WHERE filename=$filename", vars=locals())[0]["refs"]
+
+
 def db_insert_image(filename):
     """ Insert an image into the database """
     imagename, file_extension = os.path.splitext(filename)
@@ -77,24 +206,6 @@ def db_insert_image(filename):
     print(imageid)
 
 
-def write_settings(data):
-    """Write the previous image to settings file"""
-    print("Writing settings...")
-    print(data)
-    with open('settings.yml', 'w') as outfile:
-        outfile.write(yaml.dump(data, default_flow_style=True))
-
-
-def read_settings():
-    """ Read settings from YAML file"""
-    print("Read settings...")
-    try:
-        return yaml.load(open("settings.yml"))
-    except:
-        print("Could not read settings")
-        return None
-
-
 def write_log(logdata, process=""):
     """ Write to the log """
     if process == "":
@@ -122,34 +233,285 @@ def rename_image(filename):
     print(filename)
 
 
-def make_thumbnail(image):
-    """ Make thumnail for given image """
-    # if thumbnail doesn't exist
-    if not os.path.exists(os.path.join(thumbdir, image)):
-        imagepath = image
-        print(get_logtime("%s: PIL - File to open is: %s" % (cur_process,
-                                                             imagepath)))
-        try:
-            # open and convert to RGB
-            img = Image.open(imagepath).convert('RGB')
-
-            # find ratio of new height to old height
-            hpercent = (float(HEIGHT) / float(img.size[1]))
-            # apply ratio to create new width
-            wsize = int(float(img.size[0]) * hpercent)
-            # resize image with antialiasing
-            img = img.resize((int(wsize), int(HEIGHT)), Image.ANTIALIAS)
-            # save with quality of 80, optimise setting caused crash
-            img.save(imagepath, format='JPEG', quality=90)
-            write_log("Sucessfully resized: %s \n" % image)
-        except IOError:
-            write_log(
-                "IO Error. %s will be deleted and "
-                "downloaded properly next sync"
-                % imagepath)
+class UploadError(Exception):
+    """ Upload rejected, with the HTTP status to reply with """
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+def image_type(header):
+    """ Identify an image format from its first few bytes """
+    for magic, imagetype in IMAGEMAGIC:
+        if header.startswith(magic):
+            return imagetype
+    return None
+
+
+def find_upload(env, field):
+    """ A MultipartReader at the file uploaded as field, and its filename
+
+    Reads the request body itself rather than through web.input, whose
+    cgi.FieldStorage would write the whole file to disk before we see it.
+    Returns None, None if the field isn't there. """
+    boundary = multipart.boundary(env.get('CONTENT_TYPE'))
+    if boundary is None:
+        raise UploadError("400 Bad Request", "Upload the image with the form")
+    reader = multipart.MultipartReader(env['wsgi.input'], boundary,
+                                       int(env.get('CONTENT_LENGTH') or 0) or
+                                       None, UPLOADCHUNK)
+    try:
+        part = reader.next_part()
+        while part is not None:
+            name, filename = part
+            if name == field and filename is not None:
+                return reader, filename
+            part = reader.next_part()
+    except multipart.MultipartError as e:
+        raise UploadError("400 Bad Request", "%s" % e)
+    return None, None
+
+
+def store_upload(upload, maxsize):
+    """ Stream an uploaded file into IMAGEDIR
+
+    upload is read from the request as it arrives, see find_upload, and
+    copied in chunks to a temporary file, so it is only written once and
+    only one chunk is ever in memory. The first chunk must look like an
+    image, so anything else is refused before the rest is read. Returns
+    the temporary file's path and the SHA-1, for commit_upload to name it
+    by. """
+    digest = hashlib.sha1()
+    size = 0
+    tmp = tempfile.NamedTemporaryFile(dir=IMAGEDIR, suffix=".part",
+                                      delete=False)
+    try:
+        while True:
+            chunk = upload.read(UPLOADCHUNK)
+            if not chunk:
+                break
+            if size == 0 and image_type(chunk) is None:
+                raise UploadError("415 Unsupported Media Type",
+                                  "That file is not an image")
+            size += len(chunk)
+            if size > maxsize:
+                raise UploadError("413 Request Entity Too Large",
+                                  "Images must be smaller than %d MB" %
+                                  (maxsize // (1024 * 1024)))
+            digest.update(chunk)
+            tmp.write(chunk)
+        tmp.close()
+
+        if size == 0:
+            raise UploadError("400 Bad Request", "The file was empty")
+    except Exception as e:
+        tmp.close()
+        os.remove(tmp.name)
+        if isinstance(e, multipart.MultipartError):
+            raise UploadError("400 Bad Request", "%s" % e)
+        raise
+
+    return tmp.name, digest.hexdigest()
+
+
+def commit_upload(tmppath, digest):
+    """ Move a stored upload into place, named by the SHA-1 of the upload
+
+    The name is only for finding duplicate uploads: processing resizes
+    the file in place, so it no longer hashes to its name. Transfers to
+    displays are checked with the file's own hash, see file_sha1. Call
+    with UPLOADLOCK held. Returns the filename and whether it is new. A
+    duplicate is thrown away, its catalog entry shares the image that is
+    already there. """
+    filename = "%s.jpg" % digest
+    if db_refcount(filename) > 0 or filename in JOBS:
+        os.remove(tmppath)
+        return filename, False
+
+    os.rename(tmppath, os.path.join(IMAGEDIR, filename))
+    return filename, True
+
+
+def delete_image(filename):
+    """ Delete an image file and everything made from it """
+    try:
+        os.remove(os.path.join(IMAGEDIR, filename))
+        delete_renditions(filename)
+        delete_thumbnails(filename)
+        write_log("%s deleted" % filename)
+    except OSError as e:
+        write_log("Deleting %s failed" % filename)
+        write_log("Error: %s" % e)
+
+
+def resize_image(imagepath):
+    """ Scale an uploaded image down to HEIGHT and save it as a JPEG """
+    # open and convert to RGB
+    img = Image.open(imagepath).convert('RGB')
+
+    # find ratio of new height to old height
+    hpercent = (float(HEIGHT) / float(img.size[1]))
+    # apply ratio to create new width
+    wsize = int(float(img.size[0]) * hpercent)
+    # resize image with antialiasing
+    img = img.resize((int(wsize), int(HEIGHT)), Image.ANTIALIAS)
+    # save with quality of 80, optimise setting caused crash
+    img.save(imagepath, format='JPEG', quality=90)
+    write_log("Sucessfully resized: %s \n" % imagepath)
+
+
+def process_upload(filename, resolutions):
+    """ Resize an upload and make its renditions and thumbnails
+
+    Runs in a worker process, so it reports failure rather than raising,
+    and how long it took rather than recording it """
+    start = time.time()
+    imagepath = os.path.join(IMAGEDIR, filename)
+    try:
+        resize_image(imagepath)
+        # Pre-fit a copy for each kind of display
+        make_renditions(imagepath, filename, resolutions)
+    except Exception as e:
+        # Anything PIL raises, a truncated file or a decompression bomb,
+        # must still finish the job or its tile stays processing forever
+        write_log("Could not process %s: %s. It will be deleted" %
+                  (imagepath, e))
+        if os.path.exists(imagepath):
             os.remove(imagepath)
+        delete_renditions(filename)
+        return filename, False, time.time() - start
+    make_thumbnails(filename)
+    return filename, True, time.time() - start
+
+
+def upload_done(result):
+    """ Make a processed upload visible, runs in the pool's result thread """
+    filename, success, seconds = result
+    RESIZE_TIME.observe(seconds)
+    with UPLOADLOCK:
+        if success is True:
+            db.update('images', where="filename=$filename", status="ready",
+                      vars=locals())
+            state = "ready"
+            if db_refcount(filename) == 0:
+                # Deleted while it was being processed
+                delete_image(filename)
+        else:
+            db.delete('images', where="filename=$filename", vars=locals())
+            state = "failed"
+        # Finished jobs are looked up in the database, see Jobs
+        JOBS.pop(filename, None)
+    UPLOADS.inc(result=state)
+    write_log("Upload job %s %s \n" % (filename, state))
+
+
+def queue_upload(filename):
+    """ Hand an upload to the worker pool, unless it is already there """
+    with UPLOADLOCK:
+        if filename in JOBS:
+            return
+        JOBS[filename] = {"state": "processing"}
+    if POOL is None:
+        upload_done(process_upload(filename, display_resolutions()))
     else:
-        write_log("Thumbnail for %s exists \n" % image)
+        POOL.apply_async(process_upload, (filename, display_resolutions()),
+                         callback=upload_done)
+
+
+def requeue_uploads():
+    """ Finish processing uploads interrupted by a restart """
+    for image in db.select('images', where="status='processing'"):
+        queue_upload(image["filename"])
+
+
+def thumbnail_path(filename, size):
+    """ Path of the thumbnail of an image at a given width """
+    return os.path.join(THUMBDIR, str(size), filename)
+
+
+def thumbnail_valid(filename, size):
+    """ Check a thumbnail exists and is newer than its image """
+    try:
+        return (os.path.getmtime(thumbnail_path(filename, size)) >=
+                os.path.getmtime(os.path.join(IMAGEDIR, filename)))
+    except OSError:
+        return False
+
+
+def thumbnails_valid(filename):
+    """ Check every thumbnail of an image is up to date """
+    return all(thumbnail_valid(filename, size) for size in THUMBSIZES)
+
+
+def make_thumbnails(filename):
+    """ Make thumnails for given image, runs in a worker process """
+    imagepath = os.path.join(IMAGEDIR, filename)
+    try:
+        # open and convert to RGB, decoding JPEGs at a reduced size
+        img = Image.open(imagepath)
+        img.draft('RGB', (max(THUMBSIZES), max(THUMBSIZES)))
+        img = img.convert('RGB')
+
+        # Largest first, so each size is scaled from the one before
+        for size in sorted(THUMBSIZES, reverse=True):
+            if thumbnail_valid(filename, size):
+                continue
+
+            thumbpath = thumbnail_path(filename, size)
+            if not os.path.exists(os.path.dirname(thumbpath)):
+                os.makedirs(os.path.dirname(thumbpath))
+
+            # Thumbnails are a fixed width, height follows the aspect ratio
+            img.thumbnail((size, img.size[1] * size // img.size[0] or 1),
+                          Image.ANTIALIAS)
+            # Write to a temporary file so a half written thumbnail is
+            # never served
+            img.save(thumbpath + ".tmp", format='JPEG', quality=80)
+            os.rename(thumbpath + ".tmp", thumbpath)
+        return True
+    except (IOError, OSError) as e:
+        write_log("Could not make thumbnails for %s: %s \n" % (filename, e))
+        return False
+
+
+def queue_thumbnails(filenames):
+    """ Make thumbnails in the worker pool, or here if there isn't one """
+    for filename in filenames:
+        if POOL is None:
+            make_thumbnails(filename)
+        else:
+            POOL.apply_async(make_thumbnails, (filename,))
+
+
+def backfill_thumbnails():
+    """ Make any thumbnails missing for images already in the database """
+    process = "Thumbnail Backfill"
+    missing = [image["filename"] for image in db_list_images()
+               if image["status"] == "ready" and
+               not thumbnails_valid(image["filename"])]
+    write_log("%d images need thumbnails \n" % len(missing), process)
+    queue_thumbnails(missing)
+
+
+def delete_thumbnails(filename):
+    """ Delete every thumbnail of an image """
+    for size in THUMBSIZES:
+        thumbpath = thumbnail_path(filename, size)
+        if os.path.exists(thumbpath):
+            os.remove(thumbpath)
+
+
+def thumbnail_srcset(filename):
+    """ src and srcset for an image tile
+
+    The full image is used until its thumbnails exist """
+    if not thumbnails_valid(filename):
+        return "/%s" % os.path.join(IMAGEDIR, filename), ""
+
+    srcset = ", ".join("/%s %dw" % (thumbnail_path(filename, size), size)
+                       for size in THUMBSIZES)
+    return "/%s" % thumbnail_path(filename, min(THUMBSIZES)), srcset
 
 
 def list_files(directory, reverse=False):
@@ -168,182 +530,657 @@ def list_files(directory, reverse=False):
     return output
 
 
-def connect_display(display):
-    process = "connect_display"
-    """ Try and connect to a display
-    This is a bit of a clusterfuck
-    should probably re-engineer this """
-    # Make a new socket
-    write_log("Connections: " % connections, process)
-    try:
-        write_log("Remove display socket from connections", process)
-        del connections[display]
-    except KeyError, e:
-        write_log("Display doesn't exist in connections", process)
-
-    # Get display address
-    display_address = (PROJECTRS[display]["ip"], PROJECTRS[display]["port"])
-    # Make new socket it and add to connections dict
-    connections[display] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    write_log("Socket made", process)
-    # Set connections timeout low
-    connections[display].settimeout(1)
+def display_resolutions():
+    """ Return the distinct resolutions reported by the displays """
+    return sorted(set((PROJECTRS[display]["width"],
+                       PROJECTRS[display]["height"])
+                      for display in PROJECTRS
+                      if "width" in PROJECTRS[display]))
+
 
+def rendition_path(filename, resolution):
+    """ Path of the rendition of an image for a display resolution """
+    return os.path.join(RENDITIONDIR, "%dx%d" % resolution, filename)
+
+
+def make_renditions(imagepath, filename, resolutions):
+    """ Make a copy of an image pre-fitted to each display resolution """
+    for resolution in resolutions:
+        renditionpath = rendition_path(filename, resolution)
+        if os.path.exists(renditionpath):
+            # Made for a display seen before
+            continue
+
+        img = Image.open(imagepath)
+        if img.size[0] <= resolution[0] and img.size[1] <= resolution[1]:
+            # Already fits, the display can have the original
+            continue
+
+        if not os.path.exists(os.path.dirname(renditionpath)):
+            os.makedirs(os.path.dirname(renditionpath))
+
+        # Scale down to fit inside the display, keeping the aspect ratio
+        img.thumbnail(resolution, Image.ANTIALIAS)
+        # Write to a temporary file so a half written rendition is never
+        # sent to a display, or taken as made by the check above
+        img.save(renditionpath + ".tmp", format='JPEG', quality=90)
+        os.rename(renditionpath + ".tmp", renditionpath)
+        write_log("Made %dx%d rendition of %s \n" %
+                  (resolution[0], resolution[1], filename))
+
+
+def backfill_rendition(filename, resolution):
+    """ Make one image's rendition for a new resolution, runs in a worker
+
+    Reports failure rather than raising, the pool would hide it """
     try:
-        # try connecting to socket
-        connections[display].connect(display_address)
-        write_log("Connected to %s" % display, process)
-        # set socket timeout high
-        connections[display].settimeout(20)
+        make_renditions(os.path.join(IMAGEDIR, filename), filename,
+                        [resolution])
         return True
-    except:
-        write_log("No displays found", process)
-        # delete socket from dict, because it doesn't work
-        del connections[display]
-        # increment attempts
+    except (IOError, OSError) as e:
+        write_log("Could not make %dx%d rendition of %s: %s \n" %
+                  (resolution[0], resolution[1], filename, e))
         return False
 
 
-def send_msg_display(display, msg):
-    process = "Send Message To Display"
-    """ Send a message to a display """
-    write_log("Send message to display", process)
-    x = 0
-    attempts = 1
-    while x == 0 and attempts < 4:
+def backfill_renditions(resolution):
+    """ Make renditions for a newly seen resolution of images already
+    in the database, so its display isn't sent the full size originals """
+    process = "Rendition Backfill"
+    filenames = [image["filename"] for image in db_list_images()
+                 if image["status"] == "ready"]
+    write_log("Checking %d images for %dx%d renditions \n" %
+              (len(filenames), resolution[0], resolution[1]), process)
+    for filename in filenames:
+        if POOL is None:
+            backfill_rendition(filename, resolution)
+        else:
+            POOL.apply_async(backfill_rendition, (filename, resolution))
+
+
+def delete_renditions(filename):
+    """ Delete every rendition of an image """
+    if not os.path.isdir(RENDITIONDIR):
+        return
+    for resolution in os.listdir(RENDITIONDIR):
+        renditionpath = os.path.join(RENDITIONDIR, resolution, filename)
+        if os.path.exists(renditionpath):
+            os.remove(renditionpath)
+
+
+def settings_changed(settings):
+    """ Pick up displays added, changed or removed in settings.yml """
+    projectors = settings.get("projectors") or {}
+    for display in list(PROJECTRS):
+        if (PROJECTRS[display].get("discovered") is not True and
+                display not in projectors):
+            write_log("%s removed from settings" % display)
+            PROJECTRS.pop(display, None)
+    PROJECTRS.update(projectors)
+    DISPLAYS.wakeup.set()
+
+
+def discovered(display, entry):
+    """ Keep PROJECTRS in step with the displays announcing themselves
+
+    Discovered displays are keyed by the id they announce, their names
+    are only labels and every Pi starts out called raspberrypi. """
+    process = "Discovery"
+    if entry is None:
+        if PROJECTRS.get(display, {}).get("discovered") is True:
+            write_log("%s stopped announcing itself" %
+                      PROJECTRS[display]["name"], process)
+            PROJECTRS.pop(display, None)
+            DISPLAYS.wakeup.set()
+        return
+    name = entry["name"]
+
+    # Displays in settings.yml are already known, including the local one,
+    # which announces itself from our own address with our machine id
+    for known in PROJECTRS.values():
+        if known.get("discovered") is True:
+            continue
+        if (known["port"] == entry["port"] and
+                (known["ip"] == entry["ip"] or
+                 (known["ip"].startswith("127.") and
+                  entry.get("id") == discovery.machine_id()))):
+            return
+
+    if entry.get("version") != protocol.VERSION:
+        write_log("%s at %s speaks protocol %s, ignoring" %
+                  (name, entry["ip"], entry.get("version")), process)
+        return
+
+    projector = PROJECTRS.get(display)
+    if projector is None:
+        write_log("Found %s at %s:%s" % (name, entry["ip"], entry["port"]),
+                  process)
+        projector = {"enabled": True, "name": name, "current": "",
+                     "discovered": True}
+    elif projector.get("discovered") is not True:
+        write_log("%s at %s has the same id as a display in settings" %
+                  (name, entry["ip"]), process)
+        return
+
+    moved = (projector.get("ip"), projector.get("port")) != (entry["ip"],
+                                                             entry["port"])
+    if moved and "ip" in projector:
+        write_log("%s moved to %s:%s" % (name, entry["ip"], entry["port"]),
+                  process)
+        DISPLAYS.forget(display)
+
+    projector.update(name=name, ip=entry["ip"], port=entry["port"],
+                     free=entry.get("free"))
+    if "width" in entry:
+        projector.update(width=entry["width"], height=entry["height"])
+    PROJECTRS[display] = projector
+    if moved:
+        # Connect to it now rather than at the next keepalive
+        DISPLAYS.wakeup.set()
+
+
+def display_image(display, filename):
+    """ Path of the version of an image to send to a display """
+    if "width" in PROJECTRS[display]:
+        resolution = (PROJECTRS[display]["width"],
+                      PROJECTRS[display]["height"])
+        renditionpath = rendition_path(filename, resolution)
+        if os.path.exists(renditionpath):
+            return renditionpath
+    return os.path.join(IMAGEDIR, filename)
+
+
+def update_resolution(display, info):
+    """ Remember the resolution a display told us about """
+    process = "Update Resolution"
+    if "width" not in info:
+        # Projector is still starting up, it will say next time
+        return
+
+    if (PROJECTRS[display].get("width") != info["width"] or
+            PROJECTRS[display].get("height") != info["height"]):
+        write_log("%s is %dx%d" % (display, info["width"], info["height"]),
+                  process)
+        resolution = (info["width"], info["height"])
+        new = resolution not in display_resolutions()
+        PROJECTRS[display]["width"] = info["width"]
+        PROJECTRS[display]["height"] = info["height"]
+        if PROJECTRS[display].get("discovered") is not True:
+            # Keep it for uploads while the display is switched off
+            SETTINGS.changed("projectors")
+        if new:
+            # Uploads only made renditions for the displays known then
+            backfill_renditions(resolution)
+
+
+class DisplayOffline(Exception):
+    """ A display is not connected, so nothing was sent to it """
+
+
+class Clock(object):
+    """ Estimate how far a display's clock is from ours, NTP style
+
+    Each sample is a round trip, the display's time is assumed to have
+    been read half way through it. The sample with the shortest round trip
+    was delayed least on the way, so its offset is the one used. Jitter is
+    how much the offsets in the window disagree. """
+    def __init__(self, size=CLOCKSAMPLES):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, sent, remote, received):
+        rtt = received - sent
+        self.samples.append((rtt, remote - (sent + received) / 2))
+
+    def offset(self):
+        """ Seconds to add to our time to get the display's, 0 if unknown """
+        if not self.samples:
+            return 0.0
+        return min(self.samples)[1]
+
+    def stats(self):
+        if not self.samples:
+            return {"samples": 0}
+        offsets = [offset for rtt, offset in self.samples]
+        mean = sum(offsets) / len(offsets)
+        jitter = math.sqrt(sum((offset - mean) ** 2 for offset in offsets) /
+                           len(offsets))
+        return {"samples": len(self.samples), "offset": self.offset(),
+                "jitter": jitter, "rtt": min(self.samples)[0]}
+
+
+class DisplayManager(object):
+    """ Own one persistent connection to each display
+
+    A background thread connects displays, sends them keepalives and
+    reconnects with exponential backoff, so a request to a display that
+    is down fails straight away instead of waiting for it. """
+    def __init__(self, projectors):
+        self.projectors = projectors
+        self.channels = {}
+        # Seconds to wait before the next attempt, and when that is
+        self.backoff = {}
+        self.retry_at = {}
+        self.reconnects = {}
+        self.wakeup = threading.Event()
+        # What each display is doing, as it last told us
+        self.state = {}
+        self.clocks = {}
+
+    def start(self):
+        """ Start looking after the displays in the background """
+        worker = threading.Thread(target=self.run, name="DisplayManager")
+        worker.daemon = True
+        worker.start()
+
+    def run(self):
+        process = "Display Manager"
+        write_log("Looking after displays", process)
+        while True:
+            try:
+                self.check()
+            except Exception:
+                write_log("Display check failed: %s" % sys.exc_info()[1],
+                          process)
+            # Sleep until the next keepalive or retry, whichever is first
+            now = time.time()
+            delay = min([KEEPALIVE] + [self.retry_at[display] - now
+                                       for display in self.retry_at
+                                       if display not in self.channels])
+            self.wakeup.wait(max(delay, 0.1))
+            self.wakeup.clear()
+
+    def check(self):
+        """ Connect displays that are due a retry and ping the rest """
+        now = time.time()
+        pings = {}
+        # Displays the registry has forgotten
+        for display in list(self.channels):
+            if display not in self.projectors:
+                self.forget(display)
+
+        for display, projector in list(self.projectors.items()):
+            if projector.get("enabled") is not True:
+                continue
+            channel = self.channels.get(display)
+            if channel is not None and channel.closed:
+                # Closed from the other end, its reader saw EOF
+                self.disconnect(display, "connection closed")
+                channel = None
+            if channel is not None:
+                try:
+                    pings[display] = channel.request_async("alive")
+                except socket.error as e:
+                    self.disconnect(display, e)
+            elif now >= self.retry_at.get(display, 0):
+                self.connect(display)
+
+        # Pings were all sent at once, so this waits for the slowest
+        deadline = time.time() + KEEPALIVE_TIMEOUT
+        for display, pending in pings.items():
+            try:
+                reply = pending.wait(max(0, deadline - time.time()))
+            except (socket.error, protocol.RemoteError) as e:
+                self.disconnect(display, e)
+            else:
+                self.clock_sample(display, pending, reply)
+
+    def connect(self, display):
+        """ Try and connect to a display """
+        process = "Display Manager"
+        # Get display address
+        display_address = (self.projectors[display]["ip"],
+                           self.projectors[display]["port"])
+
+        channel = None
         try:
-            sock = connections[display]
-            x = 1
-        except:
-            e = sys.exc_info()[0]
-            write_log("Display %s doesn't exist: %s" % (display, e), process)
+            channel = protocol.Channel(
+                display_address, timeout=CONNECT_TIMEOUT,
+                on_event=lambda event: self.update_state(display, event))
+            # Start from what it is doing now, events keep it up to date
+            state = channel.request("whatsplaying", CONNECT_TIMEOUT)
+        except (socket.error, protocol.ProtocolError,
+                protocol.RemoteError, ValueError) as e:
+            if channel is not None:
+                channel.close()
+            self.disconnect(display, e)
+            return False
 
-            write_log("Reattach display, attempt %d" % attempts, process)
-            attempt = connect_display(display)
+        write_log("Connected to %s" % display, process)
+        # State first, pages look it up for any display with a channel
+        self.update_state(display, state)
+        self.channels[display] = channel
+        self.backoff.pop(display, None)
+        # It may have been wiped while it was away
+        PUSHED.pop(display, None)
+        update_resolution(display, channel.info)
+        self.sync_clock(display)
+        return True
 
-            if attempt is True:
-                write_log("Successfully reconnected display", process)
-            else:
-                write_log("Could not reattach display", process)
-                attempts += 1
+    def sync_clock(self, display):
+        """ Time a few round trips so the clock is known straight away """
+        self.clocks[display] = Clock()
+        for sample in range(CLOCKBURST):
+            try:
+                pending = self.channel(display).request_async("alive")
+                self.clock_sample(display, pending,
+                                  pending.wait(KEEPALIVE_TIMEOUT))
+            except (socket.error, protocol.RemoteError, DisplayOffline):
+                break
+        write_log("%s clock: %s" % (display, self.clocks[display].stats()),
+                  "Display Manager")
+
+    def clock_sample(self, display, pending, reply):
+        """ Add a timed keepalive to a display's clock estimate """
+        REQUEST_TIME.observe(pending.received - pending.sent,
+                             display=display, action="alive")
+        if reply and "time" in reply:
+            self.clocks.setdefault(display, Clock()).add(
+                pending.sent, reply["time"], pending.received)
+
+    def display_time(self, display, when):
+        """ Convert one of our times to the display's clock """
+        clock = self.clocks.get(display)
+        return when + (clock.offset() if clock is not None else 0.0)
+
+    def update_state(self, display, event):
+        """ Apply a change of state pushed by a display """
+        state = self.state.setdefault(display, {})
+        state.update((key, value) for key, value in event.items()
+                     if key != "event")
+        if "image" in event and display in self.projectors:
+            self.projectors[display]["current"] = os.path.basename(
+                event["image"])
+
+    def disconnect(self, display, reason):
+        """ Drop a display's connection and schedule the next attempt """
+        channel = self.channels.pop(display, None)
+        if channel is not None:
+            channel.close()
+            self.reconnects[display] = self.reconnects.get(display, 0) + 1
+
+        backoff = min(self.backoff.get(display, MINBACKOFF / 2) * 2,
+                      MAXBACKOFF)
+        self.backoff[display] = backoff
+        self.retry_at[display] = time.time() + backoff
+        write_log("%s offline (%s), retry in %ds" % (display, reason, backoff),
+                  "Display Manager")
+
+    def forget(self, display):
+        """ Drop everything known about a display that has gone away """
+        channel = self.channels.pop(display, None)
+        if channel is not None:
+            channel.close()
+        for known in (self.backoff, self.retry_at, self.reconnects,
+                      self.state, self.clocks, PUSHED):
+            known.pop(display, None)
+        write_log("Forgot %s" % display, "Display Manager")
+
+    def retry(self):
+        """ Try every offline display again now """
+        self.retry_at.clear()
+        self.backoff.clear()
+        self.wakeup.set()
+
+    def channel(self, display):
+        """ Return the connection to a display, if it is up """
+        channel = self.channels.get(display)
+        if channel is None or channel.closed:
+            raise DisplayOffline("%s is offline" % display)
+        return channel
+
+    def request(self, display, action, timeout=20, **params):
+        """ Send a request to a display and wait for its reply """
+        start = time.time()
+        try:
+            reply = self.channel(display).request(action, timeout, **params)
+        except protocol.ChannelClosed as e:
+            REQUEST_FAILURES.inc(display=display, action=action)
+            self.disconnect(display, e)
+            self.wakeup.set()
+            raise DisplayOffline("%s went offline" % display)
+        except (socket.error, protocol.RemoteError):
+            REQUEST_FAILURES.inc(display=display, action=action)
+            raise
+        REQUEST_TIME.observe(time.time() - start, display=display,
+                             action=action)
+        return reply
+
+    def online(self):
+        """ Displays that are connected """
+        return [display for display in list(self.channels)
+                if not self.channels[display].closed]
+
+
+def request_display(display, action, timeout=20, **params):
+    """ Send a request to a display and return its reply
+
+    Returns None if the display is offline or didn't answer. """
+    process = "Request Display"
+    try:
+        return DISPLAYS.request(display, action, timeout, **params)
+    except DisplayOffline as e:
+        write_log("Could not send %s: %s" % (action, e), process)
+    except socket.timeout:
+        write_log("No reply to %s from %s" % (action, display), process)
+    except protocol.RemoteError as e:
+        write_log("%s failed on %s: %s" % (action, display, e), process)
+    return None
+
+
+def file_sha1(path):
+    """ SHA-1 of a file, read in chunks """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(PUSHCHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def push_image(display, imagepath):
+    """ Make sure a display has an image, streaming it over if it doesn't
+
+    Returns True once the display has the image. Images a display is known
+    to have are remembered, so they are never checked or sent twice. """
+    process = "Push Image"
+    cached = PUSHED.setdefault(display, set())
+    if imagepath in cached:
+        return True
 
-    if display in connections:
-        # Prefix each message with a 4-byte length (network byte order)
-        msg = struct.pack('>I', len(msg)) + msg
+    reply = request_display(display, "have", image=imagepath)
+    if reply is None:
+        return False
 
-        # Try sending message, if broken pipe
-        # Try creating new socket
-        x = 0
-        attempts = 0
+    if reply["have"] is False:
+        if reply.get("refused"):
+            write_log("%s refused %s" % (display, imagepath), process)
+            return False
 
-        while x < 1 and attempts < 3:
-            try:
-                write_log("Attempting to send message", process)
-                sock.sendall(msg)
-                write_log("Sent message %s" % msg)
-                # success, quit loop
-                x = 1
-            except socket.error, e:
-                write_log("Socket error: %s" % e, process)
-                write_log("Attempting to reconnect to display %s" % sock,
-                          process)
-                write_log(connections)
-
-                # Make a new socket
-                del connections[display]
-                # Get display address
-                display_address = (PROJECTRS[display]["ip"], PROJECTRS[display]["port"])
-                # Make new socket it and add to connections dict
-                connections[display] = socket.socket(socket.AF_INET,
-                                                     socket.SOCK_STREAM)
-                write_log("Socket made", process)
-                # Set connections timeout low
-                connections[display].settimeout(1)
+        write_log("Sending %s to %s" % (imagepath, display), process)
+        try:
+            channel = DISPLAYS.channel(display)
+            pending = channel.request_async("store", image=imagepath,
+                                            size=os.path.getsize(imagepath),
+                                            sha1=file_sha1(imagepath))
+            with open(imagepath, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(PUSHCHUNK), b''):
+                    channel.send_data(pending.id, chunk)
+            reply = pending.wait(60)
+        except (socket.error, DisplayOffline, protocol.RemoteError) as e:
+            REQUEST_FAILURES.inc(display=display, action="store")
+            write_log("Sending %s to %s failed: %s" % (imagepath, display, e),
+                      process)
+            return False
+        REQUEST_TIME.observe(pending.received - pending.sent,
+                             display=display, action="store")
+
+        if reply["stored"] is False:
+            write_log("%s did not store %s" % (display, imagepath), process)
+            return False
+
+    cached.add(imagepath)
+    return True
+
+
+def sync_display(display):
+    """ Send a display every ready image it doesn't have yet """
+    process = "Sync Display"
+    reply = request_display(display, "sync")
+    if reply is None:
+        write_log("Could not list images on %s" % display, process)
+        return
+
+    PUSHED.setdefault(display, set()).update(reply["images"])
+    for image in db.select('images', what='filename', where="status='ready'"):
+        push_image(display, display_image(display, image["filename"]))
+    write_log("%s is in sync" % display, process)
+
+
+def display_groups():
+    """ Group names from settings, each with its member displays
+
+    A display joins groups by listing them, groups: [wall, foyer] """
+    groups = {}
+    for display in PROJECTRS:
+        for group in PROJECTRS[display].get("groups") or []:
+            groups.setdefault(group, []).append(display)
+    return groups
 
-                try:
-                    # try connecting to socket
-                    connections[display].connect(display_address)
-                    write_log("Connected to %s" % display, process)
-                    # set socket timeout high
-                    connections[display].settimeout(20)
-                except:
-                    write_log("Something fucked up", process)
-                    # delete socket from dict, because it doesn't work
-                    del connections[display]
-                    # increment attempts
-                    attempts += 1
-    else:
-        write_log("Could not send message, could not communicate with display",
-                  process)
 
+def prepare_display(display, filename, timeout=PRELOAD_TIMEOUT):
+    """ Send a display an image if it needs it and have it loaded
 
-def recv_msg(sock):
-    # Read message length and unpack it into an integer
-    raw_msglen = recvall(sock, 4)
-    if not raw_msglen:
-        return None
-    msglen = struct.unpack('>I', raw_msglen)[0]
-    # Read the message data
-    return recvall(sock, msglen)
+    Returns once the image is on the display's GPU, so it can be switched
+    to on the next frame. """
+    imagepath = display_image(display, filename)
+    if not push_image(display, imagepath):
+        return False
+    reply = request_display(display, "preload", timeout, image=imagepath)
+    return reply is not None and reply.get("loaded") is True
 
 
-def recvall(sock, n):
-    """Helper function to recv n bytes or return None if EOF is hit"""
-    data = ''
+def project_display(display, filename, at=None):
+    """ Send a display an image if it needs it and project it
 
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
-            return None
-        data += packet
+    at is when to switch, by our clock, otherwise it is straight away """
+    imagepath = display_image(display, filename)
+    if not push_image(display, imagepath):
+        return False
+    params = {"images": [imagepath]}
+    if at is not None:
+        params["at"] = DISPLAYS.display_time(display, at)
+    if request_display(display, "project", **params) is None:
+        return False
+    print("Image to be projected is %s" % filename)
+    PROJECTRS[display]["current"] = filename
+    return True
 
-    return data
 
+def slideshow_display(display, filenames):
+    """ Send a display the images it needs and start a slideshow of them """
+    imagelist = []
+    for filename in filenames:
+        imagepath = display_image(display, filename)
+        if push_image(display, imagepath):
+            imagelist.append(imagepath)
+    return request_display(display, "slideshow", images=imagelist) is not None
 
-def init_network(connections):
-    process = "Network Initialisation"
-    write_log("Check display connections", process)
-    for display in PROJECTRS:
-        if PROJECTRS[display]["enabled"] is True:
-            if display not in connections:
-                write_log("Display not in existing connections", process)
-                write_log("Connecting to display %s" % display, process)
-                display_address = (PROJECTRS[display]["ip"], PROJECTRS[display]["port"])
-                connections[display] = socket.socket(socket.AF_INET,
-                                                     socket.SOCK_STREAM)
-                write_log("Socket made", process)
-                connections[display].settimeout(1)
 
-                try:
-                    connections[display].connect(display_address)
-                    write_log("Connected to %s" % display, process)
-                    connections[display].settimeout(20)
-                except:
-                    write_log("Could not connect", process)
-                    del connections[display]
-            else:
-                send_msg_display(display, "alive")
-                try:
-                    check = recv_msg(connections[display])
-                    write_log("Already connected to %s" % display, process)
-                except:
-                    write_log("Connection appears to be dead", process)
-                    del connections[display]
-                    write_log("Connecting to display %s" % display, process)
-                    display_address = (PROJECTRS[display]["ip"], PROJECTRS[display]["port"])
-                    connections[display] = socket.socket(socket.AF_INET,
-                                                         socket.SOCK_STREAM)
-                    write_log("Socket made", process)
-                    connections[display].settimeout(1)
-
-                    try:
-                        connections[display].connect(display_address)
-                        write_log("Connected to %s" % display, process)
-                        connections[display].settimeout(20)
-                    except:
-                        write_log("Something fucked up", process)
-                        del connections[display]
-    write_log("Connections: %s" % connections, process)
+def control_display(display, action):
+    """ Pause, resume, skip or stop a display's slideshow """
+    return request_display(display, action) is not None
+
+
+def fan_out(displays, function, *args):
+    """ Call function(display, *args) for every display at once
+
+    Returns {display: {"ok": ..., "latency": seconds}}, so a group takes
+    as long as its slowest display rather than all of them added up. """
+    process = "Fan Out"
+    report = {}
+
+    def worker(display):
+        start = time.time()
+        try:
+            ok = display in DISPLAYS.online() and function(display, *args)
+        except Exception:
+            write_log("%s failed on %s: %s" % (function.__name__, display,
+                                               sys.exc_info()[1]), process)
+            ok = False
+        report[display] = {"ok": ok is True,
+                           "latency": round(time.time() - start, 3)}
+
+    workers = [threading.Thread(target=worker, args=(display,))
+               for display in displays]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return report
+
+
+def collect_metrics():
+    """ Copy counts kept by the DisplayManager and jobs into METRICS """
+    online = DISPLAYS.online()
+    for gauge in (DISPLAY_ONLINE, PENDING_REQUESTS, CLOCK_OFFSET, UPLOAD_JOBS):
+        # Displays and job states come and go
+        gauge.clear()
+    for display in list(PROJECTRS):
+        DISPLAY_ONLINE.set(display in online, display=display)
+        RECONNECTS.set(DISPLAYS.reconnects.get(display, 0), display=display)
+        channel = DISPLAYS.channels.get(display)
+        if channel is not None:
+            PENDING_REQUESTS.set(len(channel.pending), display=display)
+        clock = DISPLAYS.clocks.get(display)
+        if clock is not None and clock.samples:
+            CLOCK_OFFSET.set(clock.offset(), display=display)
+    states = collections.Counter(job["state"] for job in list(JOBS.values()))
+    for state, count in states.items():
+        UPLOAD_JOBS.set(count, state=state)
+
+
+def display_metrics():
+    """ Ask every connected display for its metrics at once
+
+    Returns {display: snapshot}, displays that don't answer in
+    METRICS_TIMEOUT are left out. """
+    process = "Display Metrics"
+    pending = {}
+    for display in DISPLAYS.online():
+        try:
+            pending[display] = DISPLAYS.channel(display).request_async(
+                "metrics")
+        except (socket.error, DisplayOffline) as e:
+            REQUEST_FAILURES.inc(display=display, action="metrics")
+            write_log("No metrics from %s: %s" % (display, e), process)
+
+    # Requests were all sent at once, so this waits for the slowest
+    deadline = time.time() + METRICS_TIMEOUT
+    snapshots = {}
+    for display, request in pending.items():
+        try:
+            reply = request.wait(max(0, deadline - time.time()))
+        except (socket.error, protocol.RemoteError) as e:
+            REQUEST_FAILURES.inc(display=display, action="metrics")
+            write_log("No metrics from %s: %s" % (display, e), process)
+            continue
+        REQUEST_TIME.observe(request.received - request.sent,
+                             display=display, action="metrics")
+        snapshots[display] = reply["metrics"]
+    return snapshots
+
+
+def image_tiles():
+    """ Tiles for the image list, (filename, name, src, srcset, status, id) """
+    imagelist = []
+    for image in db_list_images():
+        if image["status"] == "ready":
+            src, srcset = thumbnail_srcset(image["filename"])
+        else:
+            # Still processing, nothing to show yet
+            src, srcset = "/static/img/black.jpg", ""
+        imagelist.append((image["filename"], image["imagename"],
+                          src, srcset, image["status"], image["Id"]))
+    return imagelist
 
 
 # Home Page
@@ -355,25 +1192,11 @@ class Index(object):
 
         # Check if the display exists
         if current_display in [f for f in PROJECTRS]:
-            # Ask screen what is currently displayed
-            message = pickle.dumps({"action": "whatsplaying"})
-            send_msg_display(display, message)
+            # The display tells us whenever this changes
+            if display in DISPLAYS.online():
+                current_image = DISPLAYS.state.get(display, {}).get("image")
 
-            # Wait for reply
-            try:
-                current_image = recv_msg(connections[display])
-                write_log("Received TCP data: %s from %s" %
-                          (current_image, connections[display]))
-            except socket.timeout:
-                write_log("No reply, socket timed out")
-            except KeyError, e:
-                write_log("Display not found")
-
-            images = db_list_images()
-            imagelist = []
-
-            for image in images:
-                imagelist.append((image["filename"], image["imagename"]))
+            imagelist = image_tiles()
 
             if current_image is None:
                 return render.index(imagelist, "Display - %s" %
@@ -382,7 +1205,8 @@ class Index(object):
             else:
                 return render.index(imagelist, "Display - %s" %
                                     PROJECTRS[current_display]["name"],
-                                    current_image[14:], PROJECTRS, "")
+                                    os.path.basename(current_image),
+                                    PROJECTRS, "")
         else:
             write_log("Display %s not found" % (current_display))
             return render.displaynotfound("Display %s Not Found" %
@@ -399,46 +1223,107 @@ class Index(object):
             prop1 = web.input().prop1  # THE IMAGE
             prop2 = web.input().prop2
             print("action: %s, prop1: %s, prop2: %s" % (action, prop1, prop2))
-            message = pickle.dumps({"action": "project",
-                                    "images": [os.path.join(IMAGEDIR, prop1)]})
-            send_msg_display(display, message)
-            print("Image to be projected is %s" % prop1)
-            PROJECTRS[display]["current"] = prop1
-            return True
+            if not db_image_ready(prop1):
+                write_log("%s is still processing" % prop1)
+                return False
+            if display not in DISPLAYS.online():
+                web.ctx.status = "503 Service Unavailable"
+                return "offline"
+            return project_display(display, prop1)
         elif action == "slideshow":
             # Get contents of the input
             slideshow = web.input()
 
-            imagelist = []
-
-            # Get list of images
-            for image in slideshow:
-                if image != "action":
-                    print(slideshow[image])
-                    imagelist.append(slideshow[image])
+            # Get list of images, the checkbox names are the filenames
+            imagelist = [image for image in slideshow
+                         if image != "action" and db_image_ready(image)]
 
             write_log(slideshow)
 
-            message = pickle.dumps({"action": "slideshow", "images": "hello"})
-            write_log(message)
-            send_msg_display(display, message)
+            slideshow_display(display, imagelist)
             raise web.seeother('/')
+        elif action in SLIDESHOWCONTROLS:
+            return control_display(display, action)
         else:
             print("Unknown Action %s" % action)
 
 
+class Group(object):
+    """ Project to every display in a group at once """
+    def GET(self, group):
+        members = display_groups().get(group)
+        if not members:
+            write_log("Group %s not found" % group)
+            return render.displaynotfound("Group %s Not Found" % group,
+                                          PROJECTRS, "")
+
+        # Only highlight an image if the whole group is showing it
+        current = set(os.path.basename(DISPLAYS.state.get(display, {})
+                                       .get("image") or "")
+                      for display in members)
+        current_image = current.pop() if len(current) == 1 else None
+
+        return render.index(image_tiles(), "Group - %s" % group,
+                            current_image, PROJECTRS, "")
+
+    def POST(self, group):
+        members = display_groups().get(group)
+        if not members:
+            raise web.notfound()
+
+        action = web.input().action
+        if action == "project":
+            prop1 = web.input().prop1  # THE IMAGE
+            if not db_image_ready(prop1):
+                write_log("%s is still processing" % prop1)
+                return False
+            sync = SETTINGS.get("groups") or {}
+            # Get the image to everyone and loaded first, then switch them
+            # together, scheduled only once the slowest has it ready
+            report = fan_out(members, prepare_display, prop1,
+                             sync.get("preloadtimeout", PRELOAD_TIMEOUT))
+            ready = [display for display in members if report[display]["ok"]]
+            at = time.time() + sync.get("lead", SWITCH_LEAD)
+            for display, result in fan_out(ready, project_display,
+                                           prop1, at).items():
+                result["latency"] = round(result["latency"] +
+                                          report[display]["latency"], 3)
+                result["clock"] = DISPLAYS.clocks.get(display, Clock()).stats()
+                report[display] = result
+        elif action == "slideshow":
+            imagelist = [image for image in web.input()
+                         if image != "action" and db_image_ready(image)]
+            report = fan_out(members, slideshow_display, imagelist)
+            write_log("slideshow to group %s: %s" % (group, report))
+            raise web.seeother('/group/%s' % group)
+        elif action in SLIDESHOWCONTROLS:
+            report = fan_out(members, control_display, action)
+        else:
+            print("Unknown Action %s" % action)
+            raise web.badrequest()
+
+        write_log("%s to group %s: %s" % (action, group, report))
+        if not all(result["ok"] for result in report.values()):
+            # Some of the group didn't change, the report says which
+            web.ctx.status = "502 Bad Gateway"
+        web.header('Content-Type', 'application/json')
+        return json.dumps(report)
+
+
 class Videos(object):
     def GET(self):
         # Get folders in users folders
         # imagelist = list_files(IMAGEDIR)
 
-        videolist = [f for f in os.listdir(VIDEODIR) if
-                     os.path.isfile(os.path.join(VIDEODIR, f)) and
-                     f.endswith(('.mp4', '.webm'))]
+        # Animations, and folders of numbered frames, can be played too
+        videolist = sorted(f for f in os.listdir(VIDEODIR) if
+                           os.path.isdir(os.path.join(VIDEODIR, f)) or
+                           f.lower().endswith(('.mp4', '.webm') +
+                                              ANIMATIONTYPES))
 
         write_log("User accessed index")
 
-        return render.videos(videolist, "Home", PROJECTRS, "")
+        return render.videos(videolist, "Videos", PROJECTRS, "")
 
     def POST(self):
         print("Index POST")
@@ -451,9 +1336,8 @@ class Videos(object):
             prop1 = web.input().prop1  # THE video
             prop2 = web.input().prop2
             print("action: %s, prop1: %s, prop2: %s" % (action, prop1, prop2))
-            message = pickle.dumps({"action": "project",
-                                    "video": [os.path.join(VIDEODIR, prop1)]})
-            sock.sendto(message, (TCP_IP, TCP_PORT))
+            request_display("local", "project",
+                            video=[os.path.join(VIDEODIR, prop1)])
             print("video to be projected is %s" % prop1)
             return True
         else:
@@ -462,64 +1346,78 @@ class Videos(object):
 
 class initNetwork(object):
     def GET(self):
-        init_network(connections)
+        DISPLAYS.retry()
         raise web.seeother('/')
 
 
 class Settings(object):
     def GET(self):
         # Get settings
-        settingsdict = read_settings()
-        return render.settings("Settings", settingsdict, PROJECTRS, "")
+        return render.settings("Settings", SETTINGS.data, FADEEASINGS,
+                               PROJECTRS, "")
 
     def POST(self):
         newsettings = web.input()
         # newsetting is <Storage {'slideshowlength': u'20'}>
 
-        settings = read_settings()
-
-        settings["slideshow"]["delay"] = int(newsettings["slideshowlength"])
-        write_settings(settings)
+        SETTINGS["slideshow"]["delay"] = int(newsettings["slideshowlength"])
+        SETTINGS.changed("slideshow")
+        if newsettings.get("fadeeasing") in FADEEASINGS:
+            SETTINGS.set("fadeeasing", newsettings["fadeeasing"])
+        # Write it now so the projector picks it up straight away
+        SETTINGS.flush()
 
         raise web.seeother('/')
 
 
 class Delete(object):
     def GET(self):
-        image = web.input().image
+        imageid = web.input().id
 
-        return render.delete("Delete", PROJECTRS, image)
+        # Get image name from database
+        imagename = db.select('images', where="Id=$imageid",
+                              vars=locals())[0]["imagename"]
+
+        return render.delete("Delete", PROJECTRS, imageid, imagename)
 
     def POST(self):
-        image = web.input().image
-        try:
-            os.remove(os.path.join(IMAGEDIR, image))
-            write_log("%s deleted" % image)
-        except OSError, e:
-            write_log("Deleting %s failed" % image)
-            write_log("Error: %s" % e)
+        imageid = web.input().id
+        images = list(db.select('images', what='filename', where="Id=$imageid",
+                                vars=locals()))
+        if not images:
+            raise web.seeother('/')
+        filename = images[0]["filename"]
 
-        db.delete('images', where="filename=$image", vars=locals())
+        with UPLOADLOCK:
+            db.delete('images', where="Id=$imageid", vars=locals())
+
+            # Other catalog entries may share the file, and a file still
+            # being processed is deleted once its job finishes
+            refs = db_refcount(filename)
+            if refs == 0 and filename not in JOBS:
+                delete_image(filename)
+            elif refs > 0:
+                write_log("%s still used by %d images" % (filename, refs))
 
         raise web.seeother('/')
 
 
 class Rename(object):
     def GET(self):
-        image = web.input().image
+        imageid = web.input().id
 
         # Get image name from database
-        imagename = db.select('images', where="filename=$image",
+        imagename = db.select('images', where="Id=$imageid",
                               vars=locals())[0]["imagename"]
 
-        return render.rename("Rename", image, PROJECTRS, imagename)
+        return render.rename("Rename", imageid, PROJECTRS, imagename)
 
     def POST(self):
-        image = web.input().image
+        imageid = web.input().id
         newname = web.input().newname
 
         # Update image in database with new name
-        db.update('images', where="filename=$image",
+        db.update('images', where="Id=$imageid",
                   imagename=newname, vars=locals())
 
         raise web.seeother('/')
@@ -530,74 +1428,100 @@ class Upload(object):
         return render.upload("Upload", PROJECTRS, "")
 
     def POST(self):
-        image = web.input(newimage={})
-
-        if 'newimage' in image:  # to check if the file-object is created
+        # Turn away uploads that are obviously too big before reading them
+        if int(web.ctx.env.get('CONTENT_LENGTH') or 0) > UPLOADMAX:
+            web.ctx.status = "413 Request Entity Too Large"
+            return render.upload("Upload", PROJECTRS,
+                                 "Images must be smaller than %d MB" %
+                                 (UPLOADMAX // (1024 * 1024)))
+
+        start = time.time()
+        imagename = "Upload"
+        try:
+            upload, filepath = find_upload(web.ctx.env, "newimage")
+            if upload is None:
+                raise web.seeother('/')
             # replaces the windows-style slashes with linux ones.
-            filepath = image.newimage.filename.replace('\\', '/')
-            # splits the path and chooses the last part (the filename with extension)
+            filepath = filepath.replace('\\', '/')
+            # splits the path and chooses the last part (the filename
+            # with extension)
             imagename = filepath.split('/')[-1]
             imagename, file_extension = os.path.splitext(imagename)
-            imagename = imagename
+            tmppath, digest = store_upload(upload, UPLOADMAX)
+        except UploadError as e:
+            UPLOADS.inc(result="rejected")
+            write_log("%s rejected: %s" % (imagename, e.message))
+            web.ctx.status = e.status
+            return render.upload("Upload", PROJECTRS, e.message)
+        UPLOAD_TIME.observe(time.time() - start)
+        write_log("%s uploaded successfully, sha1 %s" % (imagename, digest))
+
+        with UPLOADLOCK:
+            filename, new = commit_upload(tmppath, digest)
+            if new is True or filename in JOBS:
+                status = "processing"
+            else:
+                # Same state as the entries already using the file
+                status = db.select('images', what='status',
+                                   where="filename=$filename", limit=1,
+                                   vars=locals())[0]["status"]
+            if new is not True:
+                write_log("%s is a duplicate of %s" % (imagename, filename))
+
+            # Add image to database, hidden until it has been processed
+            imageid = db.insert('images', filename=filename,
+                                imagename=imagename, folder="",
+                                status=status)
+        print("Added %s to the database as ID %d" % (imagename, imageid))
 
-            filename = "%s.jpg" % ''.join(random.choice('0123456789abcdef') for
-                                          i in range(16))
+        if new is True:
+            write_log("Queue %s for resizing" % imagename)
+            queue_upload(filename)
 
-            newimagepath = os.path.join(IMAGEDIR, filename)
+        raise web.seeother('/')
 
-            # creates the file where the uploaded file should be stored
-            fout = open(newimagepath, 'w')
-            # writes the uploaded file to the newly created file.
-            fout.write(image.newimage.file.read())
-            fout.close()  # closes the file, upload complete.
-            write_log("%s uploaded successfully" % imagename)
-            write_log("Resizing %s" % imagename)
 
-            # Add image to database
-            imageid = db.insert('images', filename=filename,
-                                imagename=imagename, folder="")
-            print("Added %s to the database as ID %d" % (imagename, imageid))
+class Jobs(object):
+    def GET(self, filename=None):
+        """ Upload job states as JSON, for tiles that are processing """
+        web.header('Content-Type', 'application/json')
+        if filename is None:
+            # Only the jobs still processing
+            return json.dumps(JOBS)
 
-            try:
-                # open and convert to RGB
-                img = Image.open(newimagepath).convert('RGB')
-
-                # find ratio of new height to old height
-                hpercent = (float(HEIGHT) / float(img.size[1]))
-                # apply ratio to create new width
-                wsize = int(float(img.size[0]) * hpercent)
-                # resize image with antialiasing
-                img = img.resize((int(wsize), int(HEIGHT)), Image.ANTIALIAS)
-                # save with quality of 80, optimise setting caused crash
-                # Delete original (in case it is a different filetype)
-                # This needs to be changed!
-                os.remove(newimagepath)
-                newimagepath = os.path.splitext(newimagepath)[0] + ".jpg"
-                img.save(newimagepath, format='JPEG', quality=90)
-                write_log("Sucessfully resized: %s \n" % newimagepath)
-            except IOError:
-                write_log("IO Error. %s will be deleted and downloaded properly next sync" % newimagepath)
-                os.remove(newimagepath)
+        if filename in JOBS:
+            job = dict(JOBS[filename])
+        else:
+            # Finished, failed uploads are removed from the database
+            rows = list(db.select('images', what='status', limit=1,
+                                  where="filename=$filename", vars=locals()))
+            job = {"state": rows[0]["status"] if rows else "failed"}
+        if job["state"] == "ready":
+            job["src"], job["srcset"] = thumbnail_srcset(filename)
+        return json.dumps(job)
 
-        raise web.seeother('/')
+
+class Metrics(object):
+    def GET(self):
+        """ Ours and every connected display's metrics, for Prometheus """
+        families = METRICS.snapshot()
+        for display, snapshot in display_metrics().items():
+            families.extend(metrics.relabel(snapshot, display=display))
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return metrics.format_text(families)
 
 
 class Displays(object):
     def GET(self):
         displays = PROJECTRS
-        print(connections)
-        alive = [f for f in connections]
+        alive = DISPLAYS.online()
 
         return render.displays("Displays", displays, alive, "")
 
     def POST(self):
         display = web.input().prop1
-        message = pickle.dumps({"action": "sync"})
-
-        sock.sendto(message, (PROJECTRS[display]["ip"],
-                              PROJECTRS[display]["port"]))
-
         print("sync %s" % display)
+        sync_display(display)
 
 
 class Shutdown(object):
@@ -610,21 +1534,44 @@ class Shutdown(object):
 
         if shutdown == "true":
             print("Shutdown")
-            message = pickle.dumps({"action": "project",
-                                    "images": ['static/img/shutdown.jpg']})
             # Should probably cycle through display and switch them off
-            send_msg_display("local", message)
+            request_display("local", "project",
+                            images=['static/img/shutdown.jpg'])
             os.system("poweroff")
         else:
             print("Don't shutdown")
             raise web.seeother('/')
 
 
-SETTINGS = read_settings()
-PROJECTRS = SETTINGS["projectors"]
+SETTINGS = settingsstore.SettingsStore('settings.yml')
+# Displays from settings, plus any found on the network. The entries are
+# shared with SETTINGS so what is learnt about them is saved.
+PROJECTRS = dict(SETTINGS["projectors"])
+# Largest upload accepted, settings are in megabytes
+UPLOADMAX = SETTINGS.get("upload", {}).get("maxsize", 40) * 1024 * 1024
+
+DISPLAYS = DisplayManager(PROJECTRS)
+METRICS.add_collector(collect_metrics)
+
+# Displays on the network announce themselves, seconds until one is forgotten
+DISCOVERY = SETTINGS.get("discovery", {})
+REGISTRY = discovery.Registry(discovered, ttl=DISCOVERY.get("ttl",
+                                                            discovery.TTL))
 
 if __name__ == "__main__":
     # Set up settings
 
-    init_network(connections)
+    db_migrate()
+
+    POOL = multiprocessing.Pool(WORKERS)
+    requeue_uploads()
+    backfill_thumbnails()
+    for resolution in display_resolutions():
+        backfill_renditions(resolution)
+
+    SETTINGS.add_listener(settings_changed)
+    SETTINGS.start()
+    DISPLAYS.start()
+    if DISCOVERY.get("enabled", True) is True:
+        REGISTRY.start()
     app.run()
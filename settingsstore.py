@@ -0,0 +1,174 @@
+""" Projectr - settings.yml, kept in memory
+
+Each process has one SettingsStore. Reads come from memory, changes are
+written behind in batches, so a busy slideshow doesn't parse and rewrite
+the YAML on the SD card for every image. Writes go to a temporary file
+that is renamed over settings.yml, so a power cut leaves either the old
+file or the new one, never half of one.
+
+The server and projector can share settings.yml, so each store watches
+the file for changes made by the other (or by hand) and reloads. Keys it
+changed itself and hasn't written yet are kept over the reloaded ones.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import copy
+import logging
+import os
+import threading
+import time
+
+import yaml
+
+# Seconds a change waits so that others can be written with it
+WRITE_DELAY = 5
+# Seconds between checks for changes made by someone else
+POLL_INTERVAL = 2
+
+
+class SettingsStore(object):
+    """ settings.yml in memory, read like a dict
+
+    Replace a top-level key with set(), or edit a value in place and then
+    call changed() with its top-level key. Either way it is written out
+    after WRITE_DELAY seconds. """
+    def __init__(self, path, defaults=None, delay=WRITE_DELAY,
+                 poll=POLL_INTERVAL):
+        self.path = path
+        self.defaults = defaults or {}
+        self.delay = delay
+        self.poll = poll
+        self.lock = threading.RLock()
+        self.data = {}
+        # Top-level keys changed here and not written yet, and since when
+        self.dirty = set()
+        self.dirty_since = None
+        # (mtime, size, inode) of the file as we last read or wrote it
+        self.signature = None
+        self.listeners = []
+        self.writes = 0
+        self.wakeup = threading.Event()
+        self.load()
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        """ Replace a top-level setting """
+        with self.lock:
+            self.data[key] = value
+            self.changed(key)
+
+    def changed(self, key):
+        """ Mark a top-level setting as needing to be written """
+        with self.lock:
+            self.dirty.add(key)
+            if self.dirty_since is None:
+                self.dirty_since = time.time()
+        self.wakeup.set()
+
+    def add_listener(self, listener):
+        """ Call listener(store) whenever the file is changed elsewhere """
+        self.listeners.append(listener)
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def read_file(self):
+        """ Parse the file, or None if it is missing or broken """
+        try:
+            with open(self.path) as infile:
+                data = yaml.load(infile)
+        except (IOError, OSError, yaml.YAMLError):
+            logging.exception("Could not read %s", self.path)
+            return None
+        return data if isinstance(data, dict) else None
+
+    def load(self):
+        """ Read the file, writing the defaults if there isn't a good one """
+        with self.lock:
+            self.signature = self.file_signature()
+            data = self.read_file() if self.signature is not None else None
+            if data is None:
+                if self.data:
+                    # Probably half way through being edited, keep what
+                    # we have until it parses again
+                    return
+                self.data.update(copy.deepcopy(self.defaults))
+                # Don't overwrite a broken file, someone may want it back
+                if self.signature is None:
+                    logging.info("Writing default settings file")
+                    self.write()
+                return
+
+            merged = copy.deepcopy(self.defaults)
+            merged.update(data)
+            # Keep what hasn't been written yet
+            for key in self.dirty:
+                if key in self.data:
+                    merged[key] = self.data[key]
+            # Update in place, callers may hold on to the store's dict
+            self.data.clear()
+            self.data.update(merged)
+
+    def write(self):
+        """ Write the settings out now, replacing the file in one go """
+        with self.lock:
+            if self.signature != self.file_signature():
+                # Changed elsewhere since we read it, don't lose that
+                self.load()
+            tmppath = self.path + ".tmp"
+            with open(tmppath, 'w') as outfile:
+                outfile.write(yaml.dump(self.data, default_flow_style=True))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.rename(tmppath, self.path)
+            self.signature = self.file_signature()
+            self.dirty.clear()
+            self.dirty_since = None
+            self.writes += 1
+
+    def flush(self):
+        """ Write any waiting changes now, for shutting down """
+        with self.lock:
+            if self.dirty:
+                self.write()
+
+    def start(self):
+        worker = threading.Thread(target=self.run, name="SettingsStore")
+        worker.daemon = True
+        worker.start()
+
+    def run(self):
+        """ Write changes behind and pick up changes made elsewhere """
+        while True:
+            self.wakeup.wait(self.poll)
+            self.wakeup.clear()
+            try:
+                self.check()
+            except (IOError, OSError):
+                logging.exception("Settings check failed")
+
+    def check(self):
+        with self.lock:
+            reloaded = self.signature != self.file_signature()
+            if reloaded:
+                logging.info("%s changed, reloading", self.path)
+                self.load()
+            if (self.dirty_since is not None and
+                    time.time() - self.dirty_since >= self.delay):
+                self.write()
+        if reloaded:
+            for listener in self.listeners:
+                listener(self)
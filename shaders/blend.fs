@@ -0,0 +1,34 @@
+// Projectr - crossfade, fragment shader
+// Samples the image fading in and the one fading out and mixes them, so
+// a fade fills the screen once instead of drawing two canvases over it.
+//
+// tex0      image fading in
+// tex1      image fading out
+// unif[15]  xy is the screen size in pixels, from Canvas.set_2d_size
+// unif[16]  x is the blend, 0 shows tex1 and 1 shows tex0
+// unif[17]  xy is the share of the screen tex0 fills once fitted
+// unif[18]  xy is the same for tex1
+precision mediump float;
+
+uniform sampler2D tex0;
+uniform sampler2D tex1;
+uniform vec3 unif[20];
+
+// An image fitted to the middle of the screen, black around it. uv is
+// where this pixel is on the screen, 0 to 1 from the top left
+vec4 fitted(sampler2D tex, vec2 uv, vec2 scale) {
+  vec2 coord = (uv - 0.5) / scale + 0.5;
+  if (any(lessThan(coord, vec2(0.0))) || any(greaterThan(coord, vec2(1.0)))) {
+    return vec4(0.0, 0.0, 0.0, 1.0);
+  }
+  return texture2D(tex, coord);
+}
+
+void main(void) {
+  // gl_FragCoord counts up from the bottom, images from the top
+  vec2 uv = gl_FragCoord.xy / unif[15].xy;
+  uv.y = 1.0 - uv.y;
+  gl_FragColor = mix(fitted(tex1, uv, unif[18].xy),
+                     fitted(tex0, uv, unif[17].xy), unif[16].x);
+  gl_FragColor.a = 1.0;
+}
@@ -0,0 +1,11 @@
+// Projectr - crossfade, vertex shader
+// pi3d's Canvas is one triangle bigger than the screen, made for shaders
+// that use no matrices, so it is passed through as it is and blend.fs
+// works out where it is from gl_FragCoord, as pi3d's 2d_flat does
+precision mediump float;
+
+attribute vec3 vertex;
+
+void main(void) {
+  gl_Position = vec4(vertex, 1.0);
+}
@@ -43,6 +43,13 @@ jQuery(function( $ ) {
 
 
 
+    $('.slideshowcontrol').on('click', function() {
+        jQuery.ajax({
+            type:"POST",
+            data: {action: $(this).data("action")}
+        });
+    });
+
     $('.menubutton').on('click', function(){
 
         if ($('nav').css('display') === 'none'){
@@ -65,15 +72,38 @@ jQuery(function( $ ) {
             $('.project').css('display', "none");
             $('.rename').css('display', "none");
             $('.slideshow-project').css('display', "block");
+            $('.slideshowcontrols').css('display', "block");
         } else {
             $('.slideshowcheck').css('display', "none");
             $('.delete').css('display', "block");
             $('.project').css('display', "block");
             $('.rename').css('display', "block");
             $('.slideshow-project').css('display', "none");
+            $('.slideshowcontrols').css('display', "none");
         }
     });
 
+    // Poll upload jobs until their tiles are ready to project
+    function checkProcessing() {
+        $('.tile.processing').each(function() {
+            var tile = $(this);
+
+            jQuery.getJSON('/jobs/' + tile.data("image"), function(job) {
+                if (job.state === "ready") {
+                    tile.find('img').first().attr({src: job.src, srcset: job.srcset});
+                    tile.removeClass('processing');
+                } else if (job.state === "failed") {
+                    tile.remove();
+                }
+            });
+        });
+
+        if ($('.tile.processing').length > 0) {
+            setTimeout(checkProcessing, 2000);
+        }
+    }
+    checkProcessing();
+
     $('.shutdownsubmit').on('click', function(){
         choice = $(this).data('choice');
         $('#choice').val(choice);
@@ -0,0 +1,255 @@
+""" Projectr - Projector benchmarks, run headless
+
+Runs the Carousel on the stand-in display in headless.py, so it works on a
+build server, and measures
+
+    pick     pick to first frame drawn, images not loaded yet and cached
+    frame    tick, collect, update and draw of a frame mid-fade, by how
+             many images are cached
+    memory   texture memory with the default cache budget
+    fade     how long fades really take, and how late they start
+
+Timings are in milliseconds, memory in bytes. Results are written as JSON,
+compare them between builds to catch regressions before flashing cards.
+
+    python tests/bench_projector.py [--output results.json]
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import numpy
+from PIL import Image
+
+import benchutil
+import headless
+import settingsstore
+
+# Gives up on anything taking longer than this, in seconds
+TIMEOUT = 30
+
+
+def make_images(directory, count, width, height):
+    """ Write test JPEGs, gradients so they compress like photos do """
+    images = []
+    gradient = numpy.linspace(0, 255, width).astype(numpy.uint8)
+    random = numpy.random.RandomState(0)
+    for number in range(count):
+        pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+        pixels[:, :, 0] = gradient
+        pixels[:, :, 1] = gradient[::-1]
+        pixels[:, :, 2] = number * 37 % 256
+        # Some detail, or the decoder has nothing to do
+        pixels[:64, :64] = random.randint(0, 256, (64, 64, 3))
+        path = os.path.join(directory, "bench%04d.jpg" % number)
+        Image.fromarray(pixels).save(path, quality=85)
+        images.append(path)
+    return images
+
+
+class Bench(object):
+    """ A headless Carousel with settings of its own """
+    def __init__(self, projector, workdir, images, args):
+        self.projector = projector
+        self.workdir = workdir
+        self.images = images
+        self.args = args
+
+    def carousel(self, fps=None, fadeduration=0, budget=None, events=None):
+        """ A fresh Carousel showing the first image
+
+        fps None draws frames as fast as they are asked for. """
+        projector = self.projector
+        headless.reset()
+        projector.pi3d = headless
+        projector.DISPLAY = headless.Display.create(
+            frames_per_second=fps, w=self.args.width, h=self.args.height)
+        projector.BLEND = headless.Shader("shaders/blend")
+
+        path = os.path.join(self.workdir, "settings.yml")
+        if os.path.exists(path):
+            os.remove(path)
+        settings = settingsstore.SettingsStore(path, projector.DEFAULTS)
+        settings.set("lastimage", self.images[0])
+        settings.set("fadeduration", fadeduration)
+        if budget is not None:
+            settings.set("texturecache", {"budget": budget})
+        projector.SETTINGS = settings
+        return projector.Carousel(events)
+
+    def frame(self, crsl):
+        """ One pass of the render loop, as in projector.py """
+        crsl.tick()
+        crsl.collect()
+        crsl.update()
+        crsl.draw()
+
+    def run_until(self, crsl, done):
+        """ Draw frames until done() is true """
+        give_up = time.time() + TIMEOUT
+        while not done():
+            if not self.projector.DISPLAY.loop_running():
+                break
+            if time.time() > give_up:
+                raise RuntimeError("Timed out waiting for the Carousel")
+            self.frame(crsl)
+
+    def show(self, crsl, image):
+        """ Pick an image and wait for its first frame, returns how long """
+        start = time.time()
+        crsl.pick(image, start)
+        self.run_until(crsl, lambda: crsl.due is None)
+        return time.time() - start
+
+    def pick(self):
+        """ Pick to first frame, at the real frame rate """
+        images = self.images[1:self.args.rounds + 1]
+        # Budget big enough that the second pass is all cache hits
+        crsl = self.carousel(fps=self.projector.FPS, budget=4096)
+        cold = [self.show(crsl, image) for image in images]
+        warm = [self.show(crsl, image) for image in images]
+        return {"cold": benchutil.summary(cold),
+                "warm": benchutil.summary(warm),
+                "stats": crsl.imagedict.stats()}
+
+    def frames(self):
+        """ Cost of a frame mid-fade as the number of images cached grows """
+        results = []
+        crsl = self.carousel(budget=4096, fadeduration=3600)
+        loaded = 1
+        for count in self.args.counts:
+            for image in self.images[loaded:count]:
+                self.show(crsl, image)
+            loaded = max(loaded, count)
+            # Fade back to one already loaded, so nothing is decoded
+            self.show(crsl, self.images[0] if crsl.focus != self.images[0]
+                      else self.images[1])
+
+            uploads = headless.STATS["uploads"]
+            timings = []
+            for _ in range(self.args.frames):
+                start = time.time()
+                self.frame(crsl)
+                timings.append(time.time() - start)
+            gc.collect()
+            results.append({"images": len(crsl.imagedict),
+                            "frame": benchutil.summary(timings),
+                            "uploads": headless.STATS["uploads"] - uploads,
+                            "cache_bytes": crsl.imagedict.used,
+                            "live_bytes": headless.live_bytes()})
+        return results
+
+    def memory(self):
+        """ Texture memory while cycling through every image """
+        crsl = self.carousel()
+        used = []
+        live = []
+        for image in self.images[1:] + self.images[:1]:
+            self.show(crsl, image)
+            self.run_until(crsl, lambda: crsl.previous is None)
+            gc.collect()
+            used.append(crsl.imagedict.used)
+            live.append(headless.live_bytes())
+        return {"budget": crsl.imagedict.budget,
+                "cache_max": max(used), "live_max": max(live),
+                "live_end": live[-1], "stats": crsl.imagedict.stats()}
+
+    def fade(self):
+        """ Fade durations against fadeduration, at the real frame rate """
+        results = []
+        for duration in self.args.fades:
+            events = []
+            crsl = self.carousel(fps=self.projector.FPS,
+                                 fadeduration=duration, budget=4096,
+                                 events=lambda event: events.append(
+                                     (time.time(), event)))
+            self.show(crsl, self.images[1])
+            self.run_until(crsl, lambda: crsl.previous is None)
+
+            actual = []
+            late = []
+            frames = []
+            for repeat in range(self.args.repeats):
+                del events[:]
+                image = self.images[repeat % 2]
+                picked = time.time()
+                draws = headless.STATS["draws"]
+                crsl.pick(image, picked)
+                self.run_until(crsl, lambda: crsl.previous is None)
+                times = dict((event["event"], at) for at, event in events)
+                actual.append(times["faded"] - times["focus"])
+                late.append(crsl.fade_start - picked)
+                frames.append(headless.STATS["draws"] - draws)
+            results.append({
+                "duration": duration,
+                "actual": benchutil.summary(actual),
+                "overshoot": benchutil.summary([took - duration
+                                                for took in actual]),
+                "start_delay": benchutil.summary(late),
+                "frames": {"expected": int(duration * self.projector.FPS),
+                           "min": min(frames), "max": max(frames)}})
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="Write the JSON here, not stdout")
+    parser.add_argument("--width", type=int, default=headless.WIDTH)
+    parser.add_argument("--height", type=int, default=headless.HEIGHT)
+    parser.add_argument("--images", type=int, default=60,
+                        help="Test images to make")
+    parser.add_argument("--rounds", type=int, default=20,
+                        help="Images picked in the pick benchmark")
+    parser.add_argument("--counts", type=int, nargs="+",
+                        default=[1, 10, 30, 60],
+                        help="Cache sizes to time frames at")
+    parser.add_argument("--frames", type=int, default=500,
+                        help="Frames timed at each cache size")
+    parser.add_argument("--fades", type=float, nargs="+", default=[0.5, 2],
+                        help="Fade durations to check, in seconds")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--only", nargs="+",
+                        choices=["pick", "frame", "memory", "fade"])
+    args = parser.parse_args()
+    if args.output is not None:
+        args.output = os.path.abspath(args.output)
+    args.counts = [min(count, args.images) for count in args.counts]
+    args.rounds = min(args.rounds, args.images - 1)
+
+    root = os.path.dirname(HERE)
+    workdir = tempfile.mkdtemp(prefix="projectr-bench-")
+    try:
+        # projector.py logs to the working directory, keep it out of the tree
+        os.chdir(workdir)
+        import projector
+
+        images = make_images(workdir, args.images, args.width, args.height)
+        bench = Bench(projector, workdir, images, args)
+        results = {"meta": benchutil.metadata(
+            width=args.width, height=args.height, images=args.images,
+            fps=projector.FPS)}
+        for name, run in (("pick", bench.pick), ("frame", bench.frames),
+                          ("memory", bench.memory), ("fade", bench.fade)):
+            if args.only is None or name in args.only:
+                print("Running %s" % name, file=sys.stderr)
+                results[name] = run()
+        results["meta"]["peak_rss"] = benchutil.peak_rss()
+    finally:
+        os.chdir(root)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    benchutil.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
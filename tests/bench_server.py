@@ -0,0 +1,237 @@
+""" Projectr - Server benchmarks
+
+Runs server.py's handlers in a scratch directory, calling the web.py app
+directly so no HTTP server is needed, against the stand-in projector in
+standin.py, which answers every request after a set delay. Measures
+
+    whatsplaying  round trips to the projector
+    upload        Upload.POST, resizing included, at each image size
+    project       Index.POST project, the first time sending the image
+    delete        Delete.POST of uploaded images and their thumbnails
+    index         Index.GET with each number of rows in images.db
+    rename        Rename.POST with the largest number of rows
+    metrics       GET /metrics, the projector's included
+
+Timings are in milliseconds with p50/p95/p99, memory in bytes. Results
+are written as JSON, compare them between builds.
+
+    python tests/bench_server.py [--output results.json]
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import benchutil
+import standin
+from standin import form_body, jpeg
+
+
+def timed(function, *args, **kwargs):
+    """ Call function, returns (seconds taken, result) """
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+class Bench(object):
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.uploaded = []
+
+    def request(self, path, method="GET", data=None, headers=None,
+                expect=("200", "303")):
+        """ Send a request to the app, failing the run if it goes wrong """
+        response = self.server.app.request(path, method=method, data=data,
+                                           headers=headers)
+        if not response.status.startswith(expect):
+            raise RuntimeError("%s %s: %s" % (method, path, response.status))
+        return response
+
+    def post_file(self, path, body):
+        """ POST a multipart body, expecting Upload.POST's redirect """
+        status = standin.post_form(self.server, path, body)
+        if not status.startswith("303"):
+            raise RuntimeError("POST %s: %s" % (path, status))
+
+    def whatsplaying(self):
+        timings = [timed(self.server.DISPLAYS.request, "local",
+                         "whatsplaying", 5)[0]
+                   for _ in range(self.args.repeats * 5)]
+        return benchutil.summary(timings)
+
+    def upload(self):
+        results = []
+        seed = 0
+        for width, height in self.args.sizes:
+            timings = []
+            sizes = []
+            for _ in range(self.args.uploads):
+                seed += 1
+                body = form_body("newimage", "bench%d.jpg" % seed,
+                                 jpeg(width, height, seed))
+                took, _ = timed(self.post_file, "/upload", body)
+                timings.append(took)
+                sizes.append(len(body))
+            results.append({"width": width, "height": height,
+                            "bytes": sum(sizes) // len(sizes),
+                            "upload": benchutil.summary(timings)})
+
+        self.uploaded = [image["filename"] for image in
+                         self.server.db.select('images', what='filename',
+                                               where="status='ready'")]
+        return results
+
+    def project(self):
+        """ Project each upload twice, the first time it is sent over """
+        first = []
+        again = []
+        for timings in (first, again):
+            for filename in self.uploaded:
+                took, _ = timed(self.request, "/", "POST",
+                                {"action": "project", "prop1": filename,
+                                 "prop2": ""})
+                timings.append(took)
+        return {"first": benchutil.summary(first),
+                "again": benchutil.summary(again)}
+
+    def delete(self):
+        timings = []
+        for filename in self.uploaded:
+            imageid = self.server.db.select('images', what='Id',
+                                            where="filename=$filename",
+                                            vars=locals())[0]["Id"]
+            timings.append(timed(self.request, "/delete", "POST",
+                                 {"id": imageid})[0])
+        return benchutil.summary(timings)
+
+    def fill(self, rows, filenames):
+        """ Replace the catalog with rows sharing some real images """
+        db = self.server.db
+        db.delete('images', where="1=1")
+        for start in range(0, rows, 500):
+            db.multiple_insert('images', values=[
+                {"filename": filenames[row % len(filenames)],
+                 "imagename": "image %d" % row, "folder": "",
+                 "status": "ready"}
+                for row in range(start, min(start + 500, rows))])
+
+    def index(self, filenames):
+        results = []
+        for rows in self.args.rows:
+            self.fill(rows, filenames)
+            # The first render compiles the templates
+            self.request("/")
+            timings = [timed(self.request, "/")[0]
+                       for _ in range(self.args.repeats)]
+            results.append({"rows": rows, "render": benchutil.summary(timings),
+                            "peak_rss": benchutil.peak_rss()})
+        return results
+
+    def rename(self):
+        ids = [image["Id"] for image in
+               self.server.db.select('images', what='Id',
+                                     limit=self.args.repeats * 5)]
+        timings = [timed(self.request, "/rename", "POST",
+                         {"id": imageid, "newname": "renamed %d" % imageid})[0]
+                   for imageid in ids]
+        return {"rows": max(self.args.rows),
+                "rename": benchutil.summary(timings)}
+
+    def metrics(self):
+        timings = []
+        for _ in range(self.args.repeats):
+            took, response = timed(self.request, "/metrics")
+            timings.append(took)
+        if "projectr_standin_request_seconds" not in response.data.decode(
+                'utf-8'):
+            raise RuntimeError("/metrics left out the projector's metrics")
+        return {"scrape": benchutil.summary(timings),
+                "bytes": len(response.data)}
+
+
+def make_library(server, count, width, height):
+    """ Images with thumbnails, for the catalog rows to share """
+    filenames = []
+    for number in range(count):
+        filename = "library%04d.jpg" % number
+        with open(os.path.join(server.IMAGEDIR, filename), 'wb') as outfile:
+            outfile.write(jpeg(width, height, 10000 + number))
+        server.make_thumbnails(filename)
+        filenames.append(filename)
+    return filenames
+
+
+def size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="Write the JSON here, not stdout")
+    parser.add_argument("--delay", type=float, default=0.005,
+                        help="Seconds the stand-in projector takes to reply")
+    parser.add_argument("--sizes", type=size, nargs="+",
+                        default=[(640, 480), (1920, 1080), (4032, 3024)],
+                        help="Upload sizes, WIDTHxHEIGHT")
+    parser.add_argument("--uploads", type=int, default=10,
+                        help="Uploads at each size")
+    parser.add_argument("--rows", type=int, nargs="+",
+                        default=[100, 1000, 10000],
+                        help="Rows in images.db to render the index with")
+    parser.add_argument("--library", type=int, default=50,
+                        help="Distinct images the rows share")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    if args.output is not None:
+        args.output = os.path.abspath(args.output)
+
+    projector = standin.StandInProjector(args.delay, 1920, 1080)
+    projector.start()
+
+    workdir = tempfile.mkdtemp(prefix="projectr-bench-")
+    # server.py logs everything to stdout, keep that out of the results
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        server = standin.scratch_server(projector, workdir)
+        bench = Bench(server, args)
+        results = {"meta": benchutil.metadata(delay=args.delay,
+                                              uploads=args.uploads,
+                                              repeats=args.repeats)}
+        for name, run in (("whatsplaying", bench.whatsplaying),
+                          ("upload", bench.upload),
+                          ("project", bench.project),
+                          ("delete", bench.delete)):
+            print("Running %s" % name, file=sys.stderr)
+            results[name] = run()
+        print("Running index", file=sys.stderr)
+        results["index"] = bench.index(make_library(server, args.library,
+                                                    1920, 1080))
+        print("Running rename", file=sys.stderr)
+        results["rename"] = bench.rename()
+        print("Running metrics", file=sys.stderr)
+        results["metrics"] = bench.metrics()
+        results["projector_requests"] = dict(projector.requests)
+        results["meta"]["peak_rss"] = benchutil.peak_rss()
+    finally:
+        sys.stdout = stdout
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    benchutil.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+""" Projectr - Shared bits of the benchmarks in this folder """
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import platform
+import resource
+import sys
+import time
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of a list of numbers """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = int(round(pct / 100 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def summary(seconds):
+    """ Count, mean and percentiles of some timings, in milliseconds """
+    if not seconds:
+        return {"count": 0}
+    values = [value * 1000 for value in seconds]
+    return {"count": len(values),
+            "mean": round(sum(values) / len(values), 3),
+            "p50": round(percentile(values, 50), 3),
+            "p95": round(percentile(values, 95), 3),
+            "p99": round(percentile(values, 99), 3),
+            "max": round(max(values), 3)}
+
+
+def peak_rss():
+    """ Most memory this process has had resident, in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kilobytes, macOS in bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def metadata(**settings):
+    """ What the results were measured on, to compare like with like """
+    return dict(settings, python=platform.python_version(),
+                platform=platform.platform(), machine=platform.machine(),
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def write_results(results, output=None):
+    """ Write results as JSON to a file, or stdout if there isn't one """
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as outfile:
+            outfile.write(text + "\n")
@@ -0,0 +1,216 @@
+""" Projectr - A stand-in projector and a scratch server for tests
+
+StandInProjector speaks the control protocol on localhost, so server.py
+can be run without a Pi, and scratch_server() imports server.py in an
+empty working directory with the stand-in as its only display. Used by
+bench_server.py and test_server.py.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import io
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import numpy
+import web
+import yaml
+from PIL import Image
+
+import metrics
+import protocol
+
+BOUNDARY = "projectrtestboundary"
+
+
+class StandInProjector(object):
+    """ Just enough of a projector to answer the server
+
+    Each connection is served by its own thread, one request at a time like
+    the real event loop, and every reply waits delay seconds first so the
+    round trip is known. Images sent to it are counted, not kept. """
+    def __init__(self, delay, width, height):
+        self.delay = delay
+        self.info = {"width": width, "height": height, "name": "standin",
+                     "version": protocol.VERSION}
+        self.state = {"image": "", "fading": False, "slideshow": False,
+                      "paused": False}
+        self.images = set()
+        self.requests = collections.Counter()
+        # Something for the server's /metrics to fetch
+        self.metrics = metrics.Registry()
+        self.request_time = self.metrics.histogram(
+            "projectr_standin_request_seconds", "Time to answer a request",
+            ("action",))
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+
+    def start(self):
+        self.spawn(self.accept)
+
+    def spawn(self, target, *args):
+        worker = threading.Thread(target=target, args=args)
+        worker.daemon = True
+        worker.start()
+
+    def accept(self):
+        while True:
+            sock, address = self.listener.accept()
+            # Events and replies are separate writes, as in projector.py
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.spawn(self.serve, sock)
+
+    def serve(self, sock):
+        try:
+            protocol.check_hello(protocol.recv_frame(sock))
+            protocol.send_frame(sock, protocol.HELLO, 0, self.info)
+            # Bytes still to come for each store request
+            transfers = {}
+            while True:
+                frame = protocol.recv_frame(sock)
+                if frame is None:
+                    break
+                kind, msgid, body = frame
+                if kind == protocol.DATA:
+                    image, left = transfers[msgid]
+                    left -= len(body)
+                    transfers[msgid] = (image, left)
+                    if left <= 0:
+                        del transfers[msgid]
+                        self.images.add(image)
+                        protocol.send_frame(sock, protocol.REPLY, msgid,
+                                            {"stored": True})
+                    continue
+
+                self.requests[body["action"]] += 1
+                start = time.time()
+                time.sleep(self.delay)
+                self.handle(sock, msgid, body, transfers)
+                self.request_time.observe(time.time() - start,
+                                          action=body["action"])
+        except (socket.error, protocol.ProtocolError):
+            pass
+        finally:
+            sock.close()
+
+    def handle(self, sock, msgid, body, transfers):
+        action = body["action"]
+        reply = {}
+        if action == "alive":
+            reply = {"time": time.time()}
+        elif action == "whatsplaying":
+            reply = dict(self.state)
+        elif action == "resolution":
+            reply = dict(self.info)
+        elif action == "metrics":
+            reply = {"metrics": self.metrics.snapshot()}
+        elif action == "sync":
+            reply = {"images": sorted(self.images)}
+        elif action == "have":
+            reply = {"have": body["image"] in self.images}
+        elif action == "preload":
+            reply = {"loaded": body["image"] in self.images}
+        elif action == "store":
+            if body["size"] > 0:
+                transfers[msgid] = (body["image"], body["size"])
+                return
+            reply = {"stored": True}
+        elif action == "project":
+            self.state["image"] = (body.get("images") or [""])[0]
+            protocol.send_frame(sock, protocol.EVENT, 0,
+                                {"event": "focus",
+                                 "image": self.state["image"],
+                                 "fading": True})
+        elif action not in ("slideshow", "stopslideshow", "pauseslideshow",
+                            "resumeslideshow", "skipslideshow"):
+            protocol.send_frame(sock, protocol.ERROR, msgid,
+                                {"error": "Unknown action %s" % action})
+            return
+        protocol.send_frame(sock, protocol.REPLY, msgid, reply)
+
+
+def jpeg(width, height, seed):
+    """ A JPEG, different for every seed so uploads aren't duplicates """
+    random = numpy.random.RandomState(seed)
+    pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    pixels[:, :, 0] = numpy.linspace(0, 255, width).astype(numpy.uint8)
+    pixels[:, :, 1] = numpy.linspace(0, 255, height).astype(
+        numpy.uint8)[:, None]
+    pixels[:, :, 2] = seed % 256
+    pixels[:64, :64] = random.randint(0, 256, (64, 64, 3))
+    out = io.BytesIO()
+    Image.fromarray(pixels).save(out, format='JPEG', quality=90)
+    return out.getvalue()
+
+
+def form_body(name, filename, content):
+    """ A multipart/form-data body with one file in it """
+    return b"".join([
+        ("--%s\r\n" % BOUNDARY).encode('ascii'),
+        ('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' %
+         (name, filename)).encode('ascii'),
+        b"Content-Type: image/jpeg\r\n\r\n",
+        content,
+        ("\r\n--%s--\r\n" % BOUNDARY).encode('ascii')])
+
+
+def post_form(server, path, body):
+    """ POST a form_body straight to the WSGI app, returns the status
+
+    app.request only sends text, so a binary upload is sent as a web
+    server would. """
+    environ = {"REQUEST_METHOD": "POST", "PATH_INFO": path,
+               "QUERY_STRING": "", "HTTP_HOST": "0.0.0.0:8080",
+               "HTTPS": "False", "wsgi.url_scheme": "http",
+               "CONTENT_TYPE": "multipart/form-data; boundary=%s" % BOUNDARY,
+               "CONTENT_LENGTH": str(len(body)),
+               "wsgi.input": io.BytesIO(body)}
+    statuses = []
+    b"".join(server.app.wsgifunc()(
+        environ, lambda status, headers: statuses.append(status)))
+    return statuses[0]
+
+
+def scratch_server(projector, workdir):
+    """ Import server.py in workdir, connected to a StandInProjector
+
+    server.py finds everything relative to the working directory, so this
+    changes into workdir and leaves the caller to change back. """
+    os.chdir(workdir)
+    os.symlink(os.path.join(ROOT, "templates"), "templates")
+    for directory in ("static/images/thumbs", "static/images/renditions",
+                      "static/videos"):
+        os.makedirs(directory)
+    with open("settings.yml", 'w') as outfile:
+        outfile.write(yaml.dump({
+            "slideshow": {"delay": 20},
+            "fadeduration": 2,
+            "discovery": {"enabled": False},
+            "projectors": {"local": {"ip": "127.0.0.1",
+                                     "port": projector.port,
+                                     "enabled": True, "name": "Main",
+                                     "current": ""}}}))
+    database = sqlite3.connect("images.db")
+    database.execute("CREATE TABLE images(Id INTEGER PRIMARY KEY, "
+                     "filename TEXT, imagename TEXT, folder TEXT, "
+                     "status TEXT DEFAULT 'ready')")
+    database.close()
+
+    # Templates are compiled once and modules aren't reloaded
+    web.config.debug = False
+    import server
+    if not server.DISPLAYS.connect("local"):
+        raise RuntimeError("Could not connect to the stand-in projector")
+    return server
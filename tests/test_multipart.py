@@ -0,0 +1,86 @@
+""" Projectr - Tests of the streaming multipart/form-data reader
+
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import multipart
+
+BODY = (b"preamble\r\n"
+        b"--xyz\r\n"
+        b'Content-Disposition: form-data; name="caption"\r\n\r\n'
+        b"hello\r\n"
+        b"--xyz\r\n"
+        b'Content-Disposition: form-data; name="newimage"; '
+        b'filename="C:\\photos\\cat.jpg"\r\n'
+        b"Content-Type: image/jpeg\r\n\r\n"
+        b"\xff\xd8\xff\r\n--xy not the end\r\n"
+        b"\r\n--xyz--\r\n")
+
+
+def parts(body, chunksize):
+    """ Every part of body, read chunksize bytes at a time """
+    reader = multipart.MultipartReader(io.BytesIO(body), b"xyz", len(body),
+                                       chunksize)
+    found = []
+    part = reader.next_part()
+    while part is not None:
+        content = b"".join(iter(reader.read, b""))
+        found.append(part + (content,))
+        part = reader.next_part()
+    return found
+
+
+class MultipartTest(unittest.TestCase):
+    def test_boundary(self):
+        self.assertEqual(multipart.boundary(
+            "multipart/form-data; boundary=xyz"), b"xyz")
+        self.assertEqual(multipart.boundary(
+            'multipart/form-data; boundary="a b"'), b"a b")
+        self.assertIsNone(multipart.boundary("application/json"))
+        self.assertIsNone(multipart.boundary(None))
+
+    def test_parts(self):
+        # Small chunks split boundaries and headers across reads
+        for chunksize in (1, 3, 7, 64, 65536):
+            self.assertEqual(parts(BODY, chunksize), [
+                ("caption", None, b"hello"),
+                ("newimage", "C:\\photos\\cat.jpg",
+                 b"\xff\xd8\xff\r\n--xy not the end\r\n")])
+
+    def test_first_chunk(self):
+        """ The start of a file is there to check before the rest """
+        reader = multipart.MultipartReader(io.BytesIO(BODY), b"xyz",
+                                           len(BODY), 4)
+        reader.next_part()
+        reader.next_part()
+        self.assertEqual(reader.read(), b"\xff\xd8\xff\r")
+
+    def test_cut_short(self):
+        with self.assertRaises(multipart.MultipartError):
+            parts(BODY[:-20], 16)
+
+    def test_no_parts(self):
+        with self.assertRaises(multipart.MultipartError):
+            parts(b"nothing to see here", 16)
+
+    def test_length(self):
+        """ Nothing past Content-Length is read """
+        stream = io.BytesIO(BODY + b"next request")
+        reader = multipart.MultipartReader(stream, b"xyz", len(BODY), 5)
+        while reader.next_part() is not None:
+            pass
+        self.assertLessEqual(stream.tell(), len(BODY))
+
+
+if __name__ == "__main__":
+    unittest.main()
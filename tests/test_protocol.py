@@ -0,0 +1,167 @@
+""" Projectr - Tests of the control protocol and the projector's end of it
+
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import protocol
+
+
+def raw_frame(kind, body):
+    """ A frame with a body that may not be valid JSON """
+    return (protocol.LENGTH.pack(protocol.HEADER.size + len(body)) +
+            protocol.HEADER.pack(protocol.VERSION, kind, 0) + body)
+
+
+class FrameTest(unittest.TestCase):
+    def test_round_trip(self):
+        buf = bytearray(protocol.encode(protocol.REQUEST, 7,
+                                        {"action": "alive"}) +
+                        protocol.encode(protocol.DATA, 7, b"\x00\xff"))
+        self.assertEqual(protocol.read_frames(buf), [
+            (protocol.REQUEST, 7, {"action": "alive"}),
+            (protocol.DATA, 7, b"\x00\xff")])
+        self.assertEqual(buf, bytearray())
+
+    def test_partial(self):
+        frame = protocol.encode(protocol.REPLY, 1, {"ok": True})
+        buf = bytearray(frame[:-1])
+        self.assertEqual(protocol.read_frames(buf), [])
+        self.assertEqual(len(buf), len(frame) - 1)
+
+    def test_oversized(self):
+        buf = bytearray(protocol.LENGTH.pack(protocol.MAXFRAME + 1))
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.read_frames(buf)
+
+    def test_undersized(self):
+        buf = bytearray(protocol.LENGTH.pack(1) + b"\x01")
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.read_frames(buf)
+
+    def test_garbled(self):
+        for body in (b"{not json", b"\xff\xfe"):
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.read_frames(bytearray(raw_frame(protocol.REQUEST,
+                                                         body)))
+
+    def test_wrong_version(self):
+        frame = bytearray(protocol.encode(protocol.HELLO, 0, {}))
+        frame[protocol.LENGTH.size] = protocol.VERSION + 1
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.read_frames(frame)
+
+    def test_hello(self):
+        body = {"version": protocol.VERSION, "name": "pi"}
+        self.assertEqual(protocol.check_hello((protocol.HELLO, 0, body)),
+                         body)
+        for frame in ((protocol.HELLO, 0, ["x"]), (protocol.HELLO, 0, None),
+                      (protocol.HELLO, 0, {"version": 0}),
+                      (protocol.REQUEST, 0, {"version": protocol.VERSION})):
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.check_hello(frame)
+        with self.assertRaises(protocol.ChannelClosed):
+            protocol.check_hello(None)
+
+
+class ControlServerTest(unittest.TestCase):
+    """ The projector's control loop, without a display or render loop """
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp(prefix="projectr-test-")
+        # projector.py logs to the working directory
+        os.chdir(cls.workdir)
+        os.makedirs("static/images")
+        import projector
+        import settingsstore
+        projector.SETTINGS = settingsstore.SettingsStore("settings.yml",
+                                                         projector.DEFAULTS)
+        cls.control = projector.ControlServer(("127.0.0.1", 0))
+        cls.control.start()
+        cls.address = ("127.0.0.1", cls.control.listener.getsockname()[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.control.running = False
+        cls.control.wake()
+        os.chdir(ROOT)
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    def send_raw(self, data):
+        """ Send data as a new peer, returns what comes back before EOF """
+        sock = socket.create_connection(self.address, 2)
+        try:
+            sock.sendall(data)
+            received = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    return received
+                received += chunk
+        finally:
+            sock.close()
+
+    def assertServing(self):
+        channel = protocol.Channel(self.address, timeout=2)
+        try:
+            self.assertIn("time", channel.request("alive", 2))
+        finally:
+            channel.close()
+        self.assertTrue(self.control.worker.is_alive())
+
+    def test_bad_hellos(self):
+        for data in (protocol.encode(protocol.HELLO, 0, ["x"]),
+                     protocol.encode(protocol.HELLO, 0, "hello"),
+                     raw_frame(protocol.HELLO, b"{garbled"),
+                     protocol.LENGTH.pack(protocol.MAXFRAME + 1) + b"x" * 8):
+            self.assertEqual(self.send_raw(data), b"")
+            self.assertServing()
+
+    def test_bad_requests(self):
+        channel = protocol.Channel(self.address, timeout=2)
+        try:
+            with self.assertRaises(protocol.RemoteError):
+                channel.request("have", 2)
+            channel.send(protocol.REQUEST, 99, ["not", "a", "request"])
+            time.sleep(0.1)
+            self.assertIn("time", channel.request("alive", 2))
+        finally:
+            channel.close()
+        self.assertServing()
+
+    def test_preload(self):
+        """ A preload is answered once the render loop has the image """
+        image = "static/images/preload.jpg"
+        channel = protocol.Channel(self.address, timeout=2)
+        try:
+            pending = channel.request_async("preload", image=image)
+            time.sleep(0.1)
+            self.assertFalse(pending.done.is_set())
+            commands = self.control.commands.take()
+            self.assertEqual(commands, [{"action": "preload",
+                                         "images": [image]}])
+            self.control.post_event({"event": "loaded", "image": image,
+                                     "loaded": True})
+            self.assertEqual(pending.wait(2), {"loaded": True})
+            self.assertEqual(channel.request("preload", 2,
+                                             image="/etc/passwd"),
+                             {"loaded": False, "refused": True})
+        finally:
+            channel.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
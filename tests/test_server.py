@@ -0,0 +1,194 @@
+""" Projectr - Tests of server.py's handlers against a stand-in projector
+
+    python -m unittest discover tests
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import standin
+from standin import form_body, jpeg
+
+
+class ServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.projector = standin.StandInProjector(0, 1920, 1080)
+        cls.projector.start()
+        cls.workdir = tempfile.mkdtemp(prefix="projectr-test-")
+        cls.server = standin.scratch_server(cls.projector, cls.workdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(ROOT)
+        shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    def add_image(self, filename, status="ready"):
+        path = os.path.join(self.server.IMAGEDIR, filename)
+        with open(path, 'wb') as outfile:
+            outfile.write(jpeg(160, 120, len(filename)))
+        self.server.db.insert('images', filename=filename, imagename=filename,
+                              folder="", status=status)
+
+    def post(self, path, data):
+        return self.server.app.request(path, method="POST", data=data)
+
+    def test_project_ready(self):
+        self.add_image("ready.jpg")
+        response = self.post("/", {"action": "project", "prop1": "ready.jpg",
+                                   "prop2": ""})
+        self.assertEqual(response.status, "200 OK")
+        self.assertTrue(self.projector.state["image"].endswith("ready.jpg"))
+
+    def test_project_processing(self):
+        self.add_image("processing.jpg", status="processing")
+        projects = self.projector.requests["project"]
+        response = self.post("/", {"action": "project",
+                                   "prop1": "processing.jpg", "prop2": ""})
+        self.assertEqual(response.status, "200 OK")
+        self.assertEqual(self.projector.requests["project"], projects)
+
+    def test_slideshow(self):
+        self.add_image("slide1.jpg")
+        self.add_image("slide2.jpg")
+        slideshows = self.projector.requests["slideshow"]
+        response = self.post("/", {"action": "slideshow", "slide1.jpg": "on",
+                                   "slide2.jpg": "on"})
+        self.assertEqual(response.status, "303 See Other")
+        self.assertEqual(self.projector.requests["slideshow"], slideshows + 1)
+
+    def test_group_project(self):
+        """ The switch is scheduled once the group has the image loaded """
+        self.add_image("group.jpg")
+        self.server.PROJECTRS["local"]["groups"] = ["wall"]
+        preloads = self.projector.requests["preload"]
+        try:
+            response = self.post("/group/wall", {"action": "project",
+                                                 "prop1": "group.jpg"})
+        finally:
+            del self.server.PROJECTRS["local"]["groups"]
+        self.assertEqual(response.status, "200 OK")
+        self.assertEqual(self.projector.requests["preload"], preloads + 1)
+        self.assertTrue(self.projector.state["image"].endswith("group.jpg"))
+
+    def test_dropped_connection_counted(self):
+        displays = self.server.DISPLAYS
+        reconnects = displays.reconnects.get("local", 0)
+        channel = displays.channels["local"]
+        channel.sock.shutdown(socket.SHUT_RDWR)
+        give_up = time.time() + 5
+        while not channel.closed and time.time() < give_up:
+            time.sleep(0.01)
+
+        displays.check()
+        self.assertNotIn("local", displays.online())
+        self.assertEqual(displays.reconnects["local"], reconnects + 1)
+
+        displays.retry_at["local"] = 0
+        displays.check()
+        self.assertIn("local", displays.online())
+
+    def image_id(self, filename):
+        return self.server.db.select('images', what='Id',
+                                     where="filename=$filename",
+                                     vars=locals())[0]["Id"]
+
+    def test_delete_shared(self):
+        self.add_image("shared.jpg")
+        self.add_image("shared.jpg")
+        path = os.path.join(self.server.IMAGEDIR, "shared.jpg")
+        response = self.post("/delete", {"id": self.image_id("shared.jpg")})
+        self.assertEqual(response.status, "303 See Other")
+        self.assertTrue(os.path.exists(path))
+        response = self.post("/delete", {"id": self.image_id("shared.jpg")})
+        self.assertEqual(response.status, "303 See Other")
+        self.assertFalse(os.path.exists(path))
+
+    def test_delete_missing(self):
+        response = self.post("/delete", {"id": 99999})
+        self.assertEqual(response.status, "303 See Other")
+
+    def parts(self):
+        """ Uploads not yet moved into place """
+        return [name for name in os.listdir(self.server.IMAGEDIR)
+                if name.endswith(".part")]
+
+    def test_upload(self):
+        content = jpeg(320, 240, 1)
+        status = standin.post_form(self.server, "/upload",
+                                   form_body("newimage", "up.jpg", content))
+        self.assertEqual(status, "303 See Other")
+        rows = list(self.server.db.select('images',
+                                          where="imagename='up'"))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["status"], "ready")
+        self.assertEqual(self.parts(), [])
+
+    def test_upload_not_image(self):
+        status = standin.post_form(self.server, "/upload",
+                                   form_body("newimage", "notes.jpg",
+                                             b"not an image" * 10000))
+        self.assertEqual(status, "415 Unsupported Media Type")
+        self.assertEqual(self.parts(), [])
+
+    def test_upload_cut_short(self):
+        body = form_body("newimage", "short.jpg", jpeg(320, 240, 2))
+        status = standin.post_form(self.server, "/upload", body[:-100])
+        self.assertEqual(status, "400 Bad Request")
+        self.assertEqual(self.parts(), [])
+
+    def test_upload_duplicates_queued_once(self):
+        """ Identical uploads before the first is processed share its job """
+        queued = []
+
+        class Pool(object):
+            def apply_async(self, function, args, callback=None):
+                queued.append((function, args, callback))
+
+        body = form_body("newimage", "twice.jpg", jpeg(320, 240, 3))
+        self.server.POOL = Pool()
+        try:
+            for _ in range(2):
+                status = standin.post_form(self.server, "/upload", body)
+                self.assertEqual(status, "303 See Other")
+        finally:
+            self.server.POOL = None
+        self.assertEqual(len(queued), 1)
+        rows = list(self.server.db.select('images',
+                                          where="imagename='twice'"))
+        self.assertEqual([row["status"] for row in rows],
+                         ["processing", "processing"])
+
+        # Deleting them all mid-job leaves the file to the job, and an
+        # upload of it then joins the job rather than starting another
+        for row in rows:
+            self.post("/delete", {"id": row["Id"]})
+        self.server.POOL = Pool()
+        try:
+            status = standin.post_form(self.server, "/upload", body)
+        finally:
+            self.server.POOL = None
+        self.assertEqual(status, "303 See Other")
+        self.assertEqual(len(queued), 1)
+
+        function, args, callback = queued[0]
+        callback(function(*args))
+        rows = list(self.server.db.select('images',
+                                          where="imagename='twice'"))
+        self.assertEqual([row["status"] for row in rows], ["ready"])
+        self.assertNotIn(rows[0]["filename"], self.server.JOBS)
+
+
+if __name__ == "__main__":
+    unittest.main()